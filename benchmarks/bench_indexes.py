@@ -0,0 +1,117 @@
+# Message lookup latency without and with the indexes added by migrations.py
+#
+#   python -m benchmarks.bench_indexes [--messages 200000] [--chats 20] [--json]
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from tortoise import Tortoise
+
+import migrations
+import tortoise_models
+
+
+def _option(name: str, default: str) -> str:
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+async def create_schema(path: str, indexes: bool):
+    await Tortoise.init(db_url=f"sqlite://{path}", modules={"models": ["tortoise_models"]})
+    await Tortoise.generate_schemas(safe=True)
+    if indexes:
+        await tortoise_models.SearchIndex.create(Tortoise.get_connection("default"))
+        await migrations.migrate()
+    await Tortoise.close_connections()
+
+
+def fill(path: str, messages: int, chats: int):
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO chat (id, title, photo) VALUES (?, ?, '')", [(i, f"chat {i}") for i in range(chats)])
+    db.execute("INSERT INTO author (id, title, photo) VALUES (1, 'author', '')")
+    started_at = datetime(2020, 1, 1)
+    rows = (
+        (
+            str(uuid.uuid4()), i, "n", i % chats, 1, f"message {i}", "[]",
+            (started_at + timedelta(seconds=i)).isoformat(), None, "[]"
+        )
+        for i in range(messages)
+    )
+    db.executemany(
+        "INSERT INTO message (id, message_id, type, chat_id, author_id, message_text, attachments_json, date, "
+        "reply_message_id, fwd_messages_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    db.commit()
+    db.close()
+
+
+def measure(path: str, messages: int, chats: int, repeat: int = 200) -> dict:
+    db = sqlite3.connect(path)
+    rnd = random.Random(0)
+
+    def timed(query, params_factory) -> float:
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            db.execute(query, params_factory()).fetchall()
+        return (time.perf_counter() - started_at) / repeat * 1000
+
+    page_ids = lambda: [rnd.randrange(messages * 2) for _ in range(200)]
+    results = {
+        "dedup_page_ms": timed(
+            f"SELECT message_id, id FROM message WHERE type = 'n' AND message_id IN ({','.join('?' * 200)})",
+            page_ids
+        ),
+        "dedup_single_ms": timed(
+            "SELECT id FROM message WHERE message_id = ? AND type = 'n' LIMIT 1",
+            lambda: [rnd.randrange(messages * 2)]
+        ),
+        "chat_page_ms": timed(
+            "SELECT * FROM message WHERE chat_id = ? ORDER BY date DESC, id DESC LIMIT 201",
+            lambda: [rnd.randrange(chats)]
+        ),
+        "chat_count_ms": timed(
+            "SELECT COUNT(*) FROM message WHERE chat_id = ?",
+            lambda: [rnd.randrange(chats)]
+        ),
+    }
+    db.close()
+    return results
+
+
+def main():
+    messages = int(_option("--messages", "200000"))
+    chats = int(_option("--chats", "20"))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.sq")
+        asyncio.run(create_schema(path, indexes=False))
+        db = sqlite3.connect(path)
+        for (name,) in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'message' AND sql IS NOT NULL"
+        ).fetchall():
+            db.execute(f"DROP INDEX {name}")
+        db.close()
+        fill(path, messages, chats)
+        before = measure(path, messages, chats)
+        asyncio.run(create_schema(path, indexes=True))
+        after = measure(path, messages, chats)
+
+    if "--json" in sys.argv:
+        print(json.dumps({"messages": messages, "chats": chats, "before": before, "after": after}, indent=2))
+        return
+    print(f"{messages} messages in {chats} chats, ms per query")
+    print(f"{'query':<20}{'before':>12}{'after':>12}")
+    for name in before:
+        print(f"{name:<20}{before[name]:>12.3f}{after[name]:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Ingest, pagination, search and render timings on a synthetic corpus served by a fake VK API
+#
+#   python -m benchmarks.bench_suite [--chats 4] [--messages 10000] [--forward-depth 2] [--forwards 0.1]
+#       [--attachments 0.3] [--mentions 0.1] [--ingest single,bulk] [--repeat 20] [--out results.json] [--json]
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+from loguru import logger
+from tortoise import Tortoise
+from tortoise.query_utils import Q
+
+import tortoise_models
+from benchmarks.fake_vk import Corpus, FakeAPI, WORDS
+from logger_client.load_messages import HistoryGenerator, Throughput
+from logger_client.scheduler import HistoryPage, save_page
+from logger_server import renderer
+from logger_server.utils import CursorPaginator
+from tortoise_models import Chat, ChatCheckpoint, Message, SearchIndex
+
+
+def _option(name: str, default: str) -> str:
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+async def timed(call: typing.Callable[[], typing.Awaitable], repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        await call()
+        samples.append((time.perf_counter() - started_at) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": statistics.mean(samples),
+        "p50_ms": samples[len(samples) // 2],
+        "p95_ms": samples[min(int(len(samples) * .95), len(samples) - 1)],
+    }
+
+
+async def open_database(path: str):
+    tortoise_models.db_path = path
+    # authors and chats of the previous database must not leak into this one
+    tortoise_models.GetMixin._cache.clear()
+    await tortoise_models.init_tortoise()
+
+
+async def ingest(api: FakeAPI, bulk: bool) -> dict:
+    calls_before = sum(api.calls.values())
+    throughput = Throughput()
+    started_at = time.perf_counter()
+    chats = await Chat.get_or_create_many_from_vk(api, api.corpus.peer_ids)
+    for peer_id in api.corpus.peer_ids:
+        chat = chats[peer_id]
+        checkpoint = await ChatCheckpoint.for_chat(chat)
+        async for page in HistoryGenerator(api, peer_id, chat.title, delay=0).pages():
+            await save_page(api, HistoryPage(chat, page, checkpoint), bulk, throughput)
+        await save_page(api, HistoryPage(chat, [], checkpoint, done=True), bulk, throughput)
+    seconds = time.perf_counter() - started_at
+    return {
+        "messages": throughput.count,
+        "stored": await Message.all().count(),
+        "seconds": seconds,
+        "messages_per_second": throughput.count / seconds,
+        "api_calls": sum(api.calls.values()) - calls_before,
+    }
+
+
+async def paginate(chat: Chat, page_size: int, repeat: int) -> dict:
+    count = await Message.filter(chat=chat).count()
+    results = {}
+    for name, depth in (("first", 0), ("depth_25", .25), ("depth_50", .5), ("depth_90", .9)):
+        cursor = None
+        if depth:
+            message = await Message.filter(chat=chat).order_by('-date', '-id').offset(int(count * depth)).first()
+            cursor = CursorPaginator.encode_cursor(message)
+        results[name] = await timed(lambda: CursorPaginator.create(
+            Message, Q(chat=chat), page_size, cursor=cursor, all_count=count, prefetch=('author',)
+        ), repeat)
+    results["last"] = await timed(lambda: CursorPaginator.create(
+        Message, Q(chat=chat), page_size, direction='last', all_count=count, prefetch=('author',)
+    ), repeat)
+    return results
+
+
+async def search(chat: Chat, repeat: int) -> dict:
+    words = iter(WORDS * repeat)
+    return {
+        "all_chats": await timed(lambda: SearchIndex.search(next(words)), repeat),
+        "one_chat": await timed(lambda: SearchIndex.search(next(words), chat_id=chat.id), repeat),
+        "two_words": await timed(lambda: SearchIndex.search(f"{next(words)} {next(words)}"), repeat),
+    }
+
+
+async def render(chat: Chat, page_size: int, repeat: int) -> dict:
+    paginator = await CursorPaginator.create(Message, Q(chat=chat), page_size, prefetch=('author',))
+    results = {"fresh_page": await timed(lambda: renderer.LayoutRenderer().render(chat, paginator, ''), repeat)}
+    await renderer.prepare_messages(paginator.items)
+    contexts = [await renderer.MessageRenderer().context(message) for message in paginator.items]
+
+    async def templates_only():
+        renderer.render_messages(contexts)
+
+    results["templates_only"] = await timed(templates_only, repeat)
+    await renderer.prerender(paginator.items)
+    results["prerendered_page"] = await timed(lambda: renderer.LayoutRenderer().render(chat, paginator, ''), repeat)
+    return results
+
+
+async def run(corpus: Corpus, modes: typing.List[str], page_size: int, repeat: int) -> dict:
+    api = FakeAPI(corpus)
+    # forwarded authors missing from the database are fetched through the renderer's api
+    renderer.api = api
+    results = {"ingest": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in modes:
+            await open_database(os.path.join(directory, f"{mode}.sq"))
+            results["ingest"][mode] = await ingest(api, bulk=mode == "bulk")
+            if mode != modes[-1]:
+                await Tortoise.close_connections()
+
+        chat = max(await Chat.all(), key=lambda chat: len(corpus.history[chat.id]))
+        results["paginate"] = await paginate(chat, page_size, repeat)
+        results["search"] = await search(chat, repeat)
+        results["render"] = await render(chat, page_size, repeat)
+        await Tortoise.close_connections()
+    return results
+
+
+def print_table(results: dict):
+    for mode, ingest_results in results["ingest"].items():
+        print(f"ingest {mode:<8}{ingest_results['messages_per_second']:>12.1f} msg/s "
+              f"({ingest_results['stored']} stored, {ingest_results['api_calls']} api calls)")
+    print(f"{'':<30}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for group in ("paginate", "search", "render"):
+        for name, timings in results[group].items():
+            print(f"{group + ' ' + name:<30}{timings['mean_ms']:>10.2f}{timings['p50_ms']:>10.2f}"
+                  f"{timings['p95_ms']:>10.2f}")
+
+
+def main():
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    parameters = dict(
+        chats=int(_option("--chats", "4")),
+        messages=int(_option("--messages", "10000")),
+        forward_rate=float(_option("--forwards", "0.1")),
+        forward_depth=int(_option("--forward-depth", "2")),
+        attachment_rate=float(_option("--attachments", "0.3")),
+        mention_rate=float(_option("--mentions", "0.1")),
+        seed=int(_option("--seed", "0")),
+    )
+    modes = _option("--ingest", "single,bulk").split(",")
+    page_size = int(_option("--page-size", "200"))
+    repeat = int(_option("--repeat", "20"))
+
+    results = {
+        "corpus": parameters,
+        "page_size": page_size,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        **asyncio.run(run(Corpus(**parameters), modes, page_size, repeat)),
+    }
+    if _option("--out", ""):
+        with open(_option("--out", ""), 'w') as f:
+            json.dump(results, f, indent=2)
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
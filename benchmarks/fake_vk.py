@@ -0,0 +1,229 @@
+# Deterministic stand-in for the VK API, the benchmarks run without a token or network
+import json
+import random
+import re
+import typing
+
+WORDS = (
+    "привет как дела что нового сегодня завтра встреча код ревью релиз тест база сервер клиент "
+    "hello world deploy fix bug merge branch commit вечером утром опять снова почему потому"
+).split()
+
+ATTACHMENT_MIX = {
+    'photo': 5,
+    'sticker': 3,
+    'link': 1,
+    'doc': 1,
+    'audio_message': 1,
+    'video': 1,
+    'gift': .2,
+}
+
+
+class Corpus:
+
+    def __init__(
+            self,
+            chats: int = 4,
+            messages: int = 2000,
+            users: int = 50,
+            groups: int = 5,
+            forward_rate: float = .1,
+            forward_depth: int = 2,
+            reply_rate: float = .15,
+            attachment_rate: float = .3,
+            attachment_mix: typing.Optional[typing.Dict[str, float]] = None,
+            mention_rate: float = .1,
+            seed: int = 0
+    ):
+        self.users = users
+        self.groups = groups
+        self.forward_rate = forward_rate
+        self.forward_depth = forward_depth
+        self.reply_rate = reply_rate
+        self.attachment_rate = attachment_rate
+        self.attachment_mix = attachment_mix or ATTACHMENT_MIX
+        self.mention_rate = mention_rate
+        self._random = random.Random(seed)
+        self._next_id = 1
+
+        # private dialogs, group chats and community dialogs in turn
+        kinds = (lambda i: i + 1, lambda i: 2000000001 + i, lambda i: -(i % groups) - 1)
+        self.peer_ids = list(dict.fromkeys(kinds[i % 3](i) for i in range(chats)))
+        self.history: typing.Dict[int, typing.List[dict]] = {peer_id: [] for peer_id in self.peer_ids}
+        for i in range(messages):
+            peer_id = self.peer_ids[i % len(self.peer_ids)]
+            self.history[peer_id].append(self._message(peer_id, self.history[peer_id]))
+        # newest first, the way messages.getHistory returns them
+        for history in self.history.values():
+            history.reverse()
+        self.messages = {msg['id']: msg for history in self.history.values() for msg in history}
+
+    def _author(self) -> int:
+        if self._random.random() < .9:
+            return self._random.randint(1, self.users)
+        return -self._random.randint(1, self.groups)
+
+    def _text(self) -> str:
+        words = self._random.choices(WORDS, k=self._random.randint(1, 30))
+        if self._random.random() < self.mention_rate:
+            user_id = self._random.randint(1, self.users)
+            words.insert(self._random.randrange(len(words) + 1), f"[id{user_id}|User {user_id}]")
+        if self._random.random() < .1:
+            words.insert(self._random.randrange(len(words) + 1), "\n")
+        return " ".join(words)
+
+    def _url(self, kind: str, ext: str) -> str:
+        return f"https://sun9-{self._random.randint(1, 99)}.userapi.com/{kind}/{self._random.getrandbits(48):x}.{ext}"
+
+    def _attachment(self) -> dict:
+        kind = self._random.choices(list(self.attachment_mix), weights=list(self.attachment_mix.values()))[0]
+        if kind == 'photo':
+            item = {
+                'id': self._random.getrandbits(30),
+                'owner_id': self._author(),
+                'sizes': [
+                    {'type': size, 'width': width, 'height': width, 'url': self._url('impg', 'jpg')}
+                    for size, width in (('s', 75), ('m', 130), ('x', 604), ('y', 807), ('z', 1080))
+                ]
+            }
+        elif kind == 'sticker':
+            sticker_id = self._random.randint(1, 40)
+            item = {
+                'sticker_id': sticker_id,
+                'images': [
+                    {'width': width, 'height': width, 'url': f"https://vk.com/sticker/1-{sticker_id}-{width}"}
+                    for width in (64, 128, 256, 512)
+                ]
+            }
+        elif kind == 'link':
+            item = {
+                'url': f"https://example.com/{self._random.getrandbits(32):x}",
+                'title': self._text()[:60],
+                'description': self._text(),
+                'photo': {'sizes': [{'type': 'x', 'url': self._url('link', 'jpg')}]}
+            }
+        elif kind == 'doc':
+            item = {
+                'title': 'file',
+                'ext': 'pdf',
+                'size': self._random.randint(1, 2 ** 24),
+                'url': self._url('doc', 'pdf')
+            }
+        elif kind == 'audio_message':
+            item = {
+                'duration': self._random.randint(1, 120),
+                'link_mp3': self._url('audio', 'mp3'),
+                'link_ogg': self._url('audio', 'ogg')
+            }
+        elif kind == 'video':
+            item = {'id': self._random.getrandbits(30), 'owner_id': self._author(), 'access_key': 'key'}
+        else:
+            item = {'id': self._random.getrandbits(30), 'thumb_256': self._url('gift', 'png')}
+        return {'type': kind, kind: item}
+
+    def _attachments(self) -> typing.List[dict]:
+        if self._random.random() >= self.attachment_rate:
+            return []
+        return [self._attachment() for _ in range(self._random.choice((1, 1, 1, 2, 4)))]
+
+    def _forwarded(self, depth: int) -> typing.List[dict]:
+        messages = []
+        for _ in range(self._random.randint(1, 3)):
+            msg = {
+                'from_id': self._author(),
+                'date': 1500000000 + self._random.getrandbits(20),
+                'text': self._text(),
+                'attachments': self._attachments()
+            }
+            if depth > 1 and self._random.random() < .5:
+                msg['fwd_messages'] = self._forwarded(depth - 1)
+            messages.append(msg)
+        return messages
+
+    def _message(self, peer_id: int, history: typing.List[dict]) -> dict:
+        message_id = self._next_id
+        self._next_id += 1
+        msg = {
+            'id': message_id,
+            'peer_id': peer_id,
+            'from_id': self._author() if peer_id > 2000000000 else self._random.choice((peer_id, 1)),
+            'date': 1600000000 + message_id * 30,
+            'text': self._text(),
+            'attachments': self._attachments(),
+            'fwd_messages': []
+        }
+        if history and self._random.random() < self.reply_rate:
+            replied = history[-1 - self._random.randrange(min(len(history), 50))]
+            msg['reply_message'] = {
+                key: replied[key] for key in ('id', 'peer_id', 'from_id', 'date', 'text', 'attachments')
+            }
+        if self.forward_depth and self._random.random() < self.forward_rate:
+            msg['fwd_messages'] = self._forwarded(self.forward_depth)
+        return msg
+
+
+class FakeAPI:
+    # duck-types the part of vkquick.API the project uses: method() and use_cache()
+
+    def __init__(self, corpus: Corpus):
+        self.corpus = corpus
+        self.calls: typing.Dict[str, int] = {}
+
+    def use_cache(self) -> "FakeAPI":
+        return self
+
+    async def method(self, name: str, **params) -> typing.Any:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if name == "execute":
+            return [
+                await self.method(method, **json.loads(method_params))
+                for method, method_params in re.findall(r"API\.([\w.]+)\((\{.*?\})\)(?=,API\.|\];$)", params['code'])
+            ]
+        return getattr(self, name.replace('.', '_'))(**params)
+
+    @staticmethod
+    def _ids(value: typing.Any) -> typing.List[int]:
+        if isinstance(value, (list, tuple)):
+            return [int(i) for i in value]
+        return [int(i) for i in str(value).split(',') if i]
+
+    def messages_getConversations(self, offset: int = 0, count: int = 20, **params) -> dict:
+        items = [
+            {'conversation': {'peer': {
+                'id': peer_id,
+                'type': 'chat' if peer_id > 2000000000 else ('user' if peer_id > 0 else 'group')
+            }}}
+            for peer_id in self.corpus.peer_ids
+        ]
+        return {'count': len(items), 'items': items[offset:offset + count]}
+
+    def messages_getHistory(self, peer_id: int, offset: int = 0, count: int = 20, start_message_id: int = None,
+                            **params) -> dict:
+        history = self.corpus.history[int(peer_id)]
+        if start_message_id:
+            history = [msg for msg in history if msg['id'] <= start_message_id]
+        return {'count': len(self.corpus.history[int(peer_id)]), 'items': history[offset:offset + count]}
+
+    def messages_getById(self, message_ids: typing.Any, **params) -> dict:
+        items = [self.corpus.messages[i] for i in self._ids(message_ids) if i in self.corpus.messages]
+        return {'count': len(items), 'items': items}
+
+    def messages_getConversationsById(self, peer_ids: typing.Any, **params) -> dict:
+        return {'count': 1, 'items': [
+            {'peer': {'id': peer_id}, 'chat_settings': {'title': f"Chat {peer_id - 2000000000}"}}
+            for peer_id in self._ids(peer_ids)
+        ]}
+
+    def users_get(self, user_ids: typing.Any, **params) -> typing.List[dict]:
+        return [
+            {'id': user_id, 'first_name': "User", 'last_name': str(user_id),
+             'photo_200': f"https://sun9-1.userapi.com/u/{user_id}.jpg"}
+            for user_id in self._ids(user_ids)
+        ]
+
+    def groups_getById(self, group_ids: typing.Any, **params) -> typing.List[dict]:
+        return [
+            {'id': group_id, 'name': f"Group {group_id}", 'photo_200': f"https://sun9-1.userapi.com/g/{group_id}.jpg"}
+            for group_id in self._ids(group_ids)
+        ]
@@ -0,0 +1,129 @@
+import contextlib
+import contextvars
+import dataclasses
+import logging
+import os
+import time
+import typing
+
+from loguru import logger
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+class Registry:
+    # the handful of counters, gauges and summaries the logger exposes in the prometheus text format
+
+    def __init__(self):
+        self._types: typing.Dict[str, str] = {}
+        self._values: typing.Dict[str, typing.Dict[Labels, typing.List[float]]] = {}
+
+    def _series(self, kind: str, name: str, labels: typing.Dict[str, typing.Any]) -> typing.List[float]:
+        self._types.setdefault(name, kind)
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        return self._values.setdefault(name, {}).setdefault(key, [0., 0.])
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._series('counter', name, labels)[0] += value
+
+    def set(self, name: str, value: float, **labels):
+        self._series('gauge', name, labels)[0] = value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._series('summary', name, labels)
+        series[0] += value
+        series[1] += 1
+
+    def get(self, name: str, **labels) -> float:
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        return self._values.get(name, {}).get(key, [0.])[0]
+
+    @staticmethod
+    def _labels(labels: Labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in sorted(self._values.items()):
+            lines.append(f"# TYPE {name} {self._types[name]}")
+            for labels, (value, count) in sorted(series.items()):
+                if self._types[name] == 'summary':
+                    lines.append(f"{name}_sum{self._labels(labels)} {value:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count:.0f}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+registry = Registry()
+
+
+@dataclasses.dataclass
+class RequestStats:
+    stages: typing.Dict[str, float] = dataclasses.field(default_factory=dict)
+    queries: int = 0
+
+
+current_request: "contextvars.ContextVar[typing.Optional[RequestStats]]" = contextvars.ContextVar(
+    'current_request', default=None
+)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    # adds the time spent in the block to the request being served, if any
+    stats = current_request.get()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.stages[name] = stats.stages.get(name, 0.) + time.perf_counter() - started_at
+
+
+class QueryCounter(logging.Handler):
+    # tortoise logs every query it sends on the "db_client" logger
+
+    def emit(self, record: logging.LogRecord):
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+        registry.inc("logger_db_queries_total")
+
+
+def count_queries():
+    db_logger = logging.getLogger("db_client")
+    if not any(isinstance(handler, QueryCounter) for handler in db_logger.handlers):
+        db_logger.addHandler(QueryCounter())
+        if db_logger.getEffectiveLevel() > logging.DEBUG:
+            db_logger.setLevel(logging.DEBUG)
+            # the debug records are only for the counter, keep them away from the root handlers
+            db_logger.propagate = False
+
+
+class ProgressLog:
+    # one aggregated line every interval seconds instead of a line per item
+
+    def __init__(self, template: str, *names: str,
+                 interval: float = float(os.environ.get("LOGGER_PROGRESS_INTERVAL", "5"))):
+        self.template = template
+        self.interval = interval
+        self.counts: typing.Dict[str, int] = dict.fromkeys(names, 0)
+        self._started_at = self._logged_at = time.monotonic()
+
+    def add(self, **counts: int):
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+        now = time.monotonic()
+        if now - self._logged_at >= self.interval:
+            self._logged_at = now
+            total = sum(self.counts.values())
+            logger.opt(colors=True).info(self.template.format(
+                **self.counts, rate=total / max(now - self._started_at, 1e-9)
+            ))
@@ -4,10 +4,43 @@ import os
 import sys
 
 import vkquick as vq
+from loguru import logger
+from tortoise import Tortoise
+
 import tortoise_models
+from logger_server import metrics, renderer
+from logger_client.export import export
+from logger_client.live import FLAGS_SET, MESSAGE_EDIT, WriteBehindQueue
 from logger_client.load_messages import load_messages
+from logger_client.media import MediaMirror
 
 app = vq.App()
+live_queue = WriteBehindQueue(
+    flush_interval=int(os.environ.get("LOGGER_LIVE_FLUSH_MS", "500")) / 1000,
+    batch_size=int(os.environ.get("LOGGER_LIVE_BATCH", "200")),
+    prerender="--prerender" in sys.argv
+)
+
+
+def _option(name: str, default: str) -> str:
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+
+def _run(coroutine):
+    async def main():
+        metrics_port = _option("--metrics-port", "")
+        runner = await metrics.serve(int(metrics_port)) if metrics_port else None
+        try:
+            await coroutine
+        finally:
+            if runner:
+                await runner.cleanup()
+            # an open aiosqlite connection keeps the process alive after the command is done
+            await Tortoise.close_connections()
+
+    asyncio.get_event_loop().run_until_complete(main())
 
 
 @app.on_startup()
@@ -15,13 +48,94 @@ async def on_startup(*args, **kwargs):
     await tortoise_models.init_tortoise()
 
 
+@app.on_shutdown()
+async def on_shutdown(*args, **kwargs):
+    await live_queue.close()
+    await Tortoise.close_connections()
+
+
 @app.on_message()
 async def handler(ctx: vq.NewMessage):
-    await tortoise_models.Message.parse_or_get(ctx.api, ctx.msg.id, tortoise_models.Message.TypeEnum.NEW_MESSAGE)
+    live_queue.put_message(ctx.api, ctx.msg.fields)
+
+
+@app.on_event(MESSAGE_EDIT, FLAGS_SET, "message_edit")
+async def change_handler(ctx: vq.NewEvent):
+    live_queue.put_event(ctx.api, ctx.event.type, ctx.event.content)
 
 
 if __name__ == "__main__":
+    tortoise_models.db_path = _option("--db", tortoise_models.db_path)
+    tortoise_models.database_url = _option("--db-url", tortoise_models.database_url)
+    tortoise_models.media_dir = _option("--media-dir", tortoise_models.media_dir)
+    media_mirror = MediaMirror(
+        connections=int(_option("--media-connections", "8")),
+        requests_per_second=float(_option("--media-rps", "20"))
+    )
     if "load_messages" in sys.argv:
-        asyncio.get_event_loop().run_until_complete(load_messages(vq.API(os.environ.get("USER_ACCESS_TOKEN"))))
+        async def load():
+            await load_messages(
+                vq.API(os.environ.get("USER_ACCESS_TOKEN")),
+                bulk="--bulk" in sys.argv,
+                concurrency=int(_option("--concurrency", "1")),
+                requests_per_second=float(_option("--rps", "3")),
+                execute="--execute" in sys.argv,
+                incremental="--incremental" in sys.argv,
+                prerender="--prerender" in sys.argv
+            )
+            if "--mirror-media" in sys.argv:
+                await media_mirror.run()
+
+        _run(load())
+    elif "reindex" in sys.argv:
+        async def reindex():
+            await tortoise_models.init_tortoise()
+            await tortoise_models.SearchIndex.rebuild()
+
+        _run(reindex())
+    elif "compact" in sys.argv:
+        async def compact():
+            await tortoise_models.init_tortoise()
+            file_size = os.path.getsize(tortoise_models.db_path) if not tortoise_models.database_url else None
+            before, after = await tortoise_models.Message.compact()
+            logger.opt(colors=True).info(
+                f"Message JSON: <green>{before / 2 ** 20:.1f}</green> MB -> <green>{after / 2 ** 20:.1f}</green> MB "
+                f"(<green>{100 - after * 100 / max(before, 1):.0f}%</green> saved)"
+            )
+            if file_size is not None:
+                conn = Tortoise.get_connection("default")
+                await conn.execute_script("VACUUM")
+                await conn.execute_script("PRAGMA wal_checkpoint(TRUNCATE)")
+                logger.opt(colors=True).info(
+                    f"Database file: <green>{file_size / 2 ** 20:.1f}</green> MB -> "
+                    f"<green>{os.path.getsize(tortoise_models.db_path) / 2 ** 20:.1f}</green> MB"
+                )
+
+        _run(compact())
+    elif "mirror_media" in sys.argv:
+        async def mirror_media():
+            await tortoise_models.init_tortoise()
+            await media_mirror.run()
+
+        _run(mirror_media())
+    elif "export" in sys.argv:
+        async def export_chats():
+            await tortoise_models.init_tortoise()
+            peer_ids = _option("--peer-id", "")
+            await export(
+                _option("--out", "export"),
+                export_format=_option("--format", "jsonl"),
+                peer_ids=[int(peer_id) for peer_id in peer_ids.split(",")] if peer_ids else None,
+                workers=int(_option("--workers", str(os.cpu_count() or 1))),
+                page_size=int(_option("--page-size", "200"))
+            )
+
+        _run(export_chats())
+    elif "prerender" in sys.argv:
+        async def prerender():
+            await tortoise_models.init_tortoise()
+            await renderer.prerender_all()
+
+        _run(prerender())
     else:
         app.run("$USER_ACCESS_TOKEN")
@@ -0,0 +1,182 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import json
+import math
+import multiprocessing
+import os
+import shutil
+from typing import AsyncIterator, List, Optional
+
+from loguru import logger
+from tortoise import Tortoise
+from tortoise.query_utils import Q
+
+import tortoise_models
+from logger_server.renderer import LayoutRenderer, ListOfChatsRenderer
+from logger_server.utils import CursorPaginator
+from tortoise_models import Chat, Message
+
+FORMATS = ('jsonl', 'html')
+
+
+@dataclasses.dataclass
+class StaticPaginator(CursorPaginator[Message]):
+    # pages of an exported chat are files next to each other, newest messages on index.html
+    page: int = 1
+    pages: int = 1
+    date_jumps = False
+
+    @staticmethod
+    def page_url(page: int) -> str:
+        return "index.html" if page == 1 else f"page-{page}.html"
+
+    @property
+    def first_url(self) -> str:
+        return self.page_url(1)
+
+    @property
+    def last_url(self) -> str:
+        return self.page_url(self.pages)
+
+    @property
+    def next_url(self) -> str:
+        return self.page_url(self.page + 1)
+
+    @property
+    def prev_url(self) -> str:
+        return self.page_url(self.page - 1)
+
+
+async def iter_messages(chat_id: int, chunk_size: int = 1000) -> AsyncIterator[List[Message]]:
+    # chronological keyset iteration, only one chunk is ever held in memory
+    cursor = None
+    while True:
+        qs = Q(chat_id=chat_id)
+        if cursor:
+            qs &= Q(date__gt=cursor.date) | Q(date=cursor.date, id__gt=cursor.id)
+        messages = await Message.filter(qs).order_by('date', 'id').prefetch_related('author').limit(chunk_size)
+        if not messages:
+            return
+        yield messages
+        cursor = messages[-1]
+
+
+def message_json(message: Message) -> dict:
+    return dict(
+        id=str(message.id),
+        message_id=message.message_id,
+        type=message.type.value,
+        date=message.date.isoformat(),
+        author=dict(id=message.author.id, name=message.author.title, photo=message.author.photo),
+        text=message.message_text,
+        attachments=message.attachments,
+        fwd_messages=message.fwd_messages,
+        reply_message_id=str(message.reply_message_id) if message.reply_message_id else None
+    )
+
+
+async def export_jsonl(chat: Chat, directory: str) -> int:
+    path = os.path.join(directory, f"{chat.id}.jsonl")
+    count = 0
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        async for messages in iter_messages(chat.id):
+            f.write("".join(json.dumps(message_json(message), ensure_ascii=False) + "\n" for message in messages))
+            count += len(messages)
+    os.replace(f"{path}.tmp", path)
+    return count
+
+
+async def export_html(chat: Chat, directory: str, page_size: int = 200) -> int:
+    directory = os.path.join(directory, str(chat.id))
+    os.makedirs(directory, exist_ok=True)
+    qs = Q(chat=chat, type=Message.TypeEnum.NEW_MESSAGE)
+    all_count = await Message.filter(qs).count()
+    pages = max(math.ceil(all_count / page_size), 1)
+    cursor = None
+    for page in range(1, pages + 1):
+        paginator = await StaticPaginator.create(
+            Message,
+            qs,
+            page_size,
+            cursor=cursor,
+            all_count=all_count,
+            prefetch=('author',)
+        )
+        paginator.page, paginator.pages = page, pages
+        path = os.path.join(directory, StaticPaginator.page_url(page))
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            async for chunk in LayoutRenderer().stream(chat, paginator, ''):
+                f.write(chunk)
+        os.replace(f"{path}.tmp", path)
+        if not paginator.has_next:
+            break
+        cursor = CursorPaginator.encode_cursor(paginator.items[-1])
+    return all_count
+
+
+async def export_chat(chat_id: int, directory: str, export_format: str, page_size: int = 200) -> int:
+    chat = await Chat.get(id=chat_id)
+    if export_format == 'html':
+        return await export_html(chat, directory, page_size)
+    return await export_jsonl(chat, directory)
+
+
+def _export_in_process(settings: dict, chat_id: int, directory: str, export_format: str, page_size: int) -> int:
+    for name, value in settings.items():
+        setattr(tortoise_models, name, value)
+
+    async def main():
+        await tortoise_models.init_tortoise(read_only=True)
+        try:
+            return await export_chat(chat_id, directory, export_format, page_size)
+        finally:
+            await Tortoise.close_connections()
+
+    return asyncio.run(main())
+
+
+async def export(
+        directory: str,
+        export_format: str = 'jsonl',
+        peer_ids: Optional[List[int]] = None,
+        workers: int = 0,
+        page_size: int = 200
+):
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format {export_format!r}, expected one of {', '.join(FORMATS)}")
+    os.makedirs(directory, exist_ok=True)
+    chats = await (Chat.filter(id__in=peer_ids) if peer_ids else Chat.all())
+    if export_format == 'html':
+        # the exported site is served from its root like the live server
+        with open(os.path.join(directory, "index.html"), 'w', encoding='utf-8') as f:
+            f.write(await ListOfChatsRenderer().render('', *chats))
+        shutil.copytree(
+            os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static'),
+            os.path.join(directory, 'static'),
+            dirs_exist_ok=True
+        )
+
+    exported = 0
+    if workers <= 1:
+        for chat in chats:
+            exported += await export_chat(chat.id, directory, export_format, page_size)
+            logger.opt(colors=True).info(f"Exported <green>{chat.title}</green>, <green>{exported}</green> messages")
+        return exported
+
+    settings = dict(
+        db_path=tortoise_models.db_path,
+        database_url=tortoise_models.database_url,
+        media_dir=tortoise_models.media_dir
+    )
+    loop = asyncio.get_running_loop()
+    # spawn: forking would copy the event loop and the database driver thread of this process
+    with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            loop.run_in_executor(pool, _export_in_process, settings, chat.id, directory, export_format, page_size)
+            for chat in chats
+        ]
+        for future in asyncio.as_completed(futures):
+            exported += await future
+            logger.opt(colors=True).info(f"Exported <green>{exported}</green> messages")
+    return exported
@@ -0,0 +1,46 @@
+import json
+from typing import List
+
+import vkquick as vq
+from loguru import logger
+
+from instrumentation import registry
+from logger_client.scheduler import RateLimitedAPI
+
+
+class DirectFetcher:
+    batch_size = 1
+
+    def __init__(self, api: vq.API):
+        self._api = api
+
+    async def fetch(self, method: str, requests: List[dict]) -> List[dict]:
+        return [await self._api.method(method, **params) for params in requests]
+
+
+class ExecuteFetcher(DirectFetcher):
+    # VK allows at most 25 API calls inside one execute
+    batch_size = 25
+
+    async def fetch(self, method: str, requests: List[dict]) -> List[dict]:
+        if len(requests) == 1:
+            return await super().fetch(method, requests)
+
+        code = "return [{}];".format(
+            ",".join(f"API.{method}({json.dumps(params, ensure_ascii=False)})" for params in requests)
+        )
+        try:
+            responses = await self._api.method("execute", code=code)
+        except Exception as ex:
+            if getattr(ex, 'code', None) in RateLimitedAPI.RATE_LIMIT_CODES:
+                raise
+            logger.warning(f"execute {method} failed ({ex}), fall back to single requests")
+            registry.inc("logger_vk_api_retries_total", method=method)
+            return await super().fetch(method, requests)
+
+        # failed calls inside execute come back as false, retry only them
+        for i, (params, response) in enumerate(zip(requests, responses)):
+            if not response:
+                registry.inc("logger_vk_api_retries_total", method=method)
+                responses[i] = (await super().fetch(method, [params]))[0]
+        return responses
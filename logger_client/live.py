@@ -0,0 +1,194 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import vkquick as vq
+from loguru import logger
+
+from instrumentation import registry
+from logger_server import renderer
+from tortoise_models import Chat, Message
+
+# user long poll codes: 2 - flags set on a message, 5 - message edited
+FLAGS_SET, MESSAGE_EDIT = 2, 5
+# 128 - deleted for the account, 131072 - deleted for everyone
+DELETED_FLAGS = 128 | 131072
+# flushes an event may fail in before it is dropped
+MAX_ATTEMPTS = 3
+
+
+class WriteBehindQueue:
+    # the long poll handlers only put events here, they are written in batches every flush_interval
+    # seconds or as soon as batch_size events are waiting
+
+    def __init__(self, flush_interval: float = .5, batch_size: int = 200, prerender: bool = False):
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._prerender = prerender
+        self._api: Optional[vq.API] = None
+        self._messages: List[dict] = []
+        # edits without the full message in the event are fetched by id at flush time
+        self._edits: List[dict] = []
+        self._deletions: List[Tuple[int, int, datetime]] = []
+        self._attempts: Dict[Tuple[str, int, int], int] = {}
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._messages) + len(self._edits) + len(self._deletions)
+
+    def _added(self, api: vq.API):
+        self._api = api
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        registry.set("logger_live_queue_size", len(self))
+        if len(self) >= self._batch_size:
+            self._full.set()
+
+    def put_message(self, api: vq.API, message: dict):
+        self._messages.append(message)
+        self._added(api)
+
+    def put_edit(self, api: vq.API, message: dict):
+        self._edits.append(message)
+        self._added(api)
+
+    def put_deletion(self, api: vq.API, message_id: int, peer_id: int):
+        self._deletions.append((message_id, peer_id, datetime.now()))
+        self._added(api)
+
+    def put_event(self, api: vq.API, event_type: Any, content: Any):
+        if isinstance(content, dict):
+            # community long poll events carry the whole message
+            message = content.get('object', content)
+            message = message.get('message', message)
+            if event_type == "message_edit":
+                self.put_edit(api, message)
+            return
+        if event_type == MESSAGE_EDIT:
+            self.put_edit(api, {'id': content[1], 'peer_id': content[3]})
+        elif event_type == FLAGS_SET and content[2] & DELETED_FLAGS:
+            self.put_deletion(api, content[1], content[3])
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._full.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def close(self):
+        # lets a flush in progress finish and writes what is still waiting
+        self._closed = True
+        self._full.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    @staticmethod
+    def _key(kind: str, item: Any) -> Tuple[str, int, int]:
+        if isinstance(item, tuple):
+            return kind, item[1], item[0]
+        return kind, item['peer_id'], item['id']
+
+    def _done(self, kind: str, items: List[Any]):
+        if self._attempts:
+            for item in items:
+                self._attempts.pop(self._key(kind, item), None)
+
+    def _failed(self, kind: str, items: List[Any], queue: List[Any], ex: Exception):
+        # puts the items back for the next flush, unless they have already failed MAX_ATTEMPTS times
+        registry.inc("logger_ingest_errors_total", stage="live")
+        logger.exception(ex)
+        dropped = 0
+        for item in items:
+            key = self._key(kind, item)
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] < MAX_ATTEMPTS:
+                queue.append(item)
+            else:
+                del self._attempts[key]
+                dropped += 1
+        if dropped:
+            logger.opt(colors=True).warning(
+                f"Dropped <red>{dropped}</red> {kind} events after {MAX_ATTEMPTS} failed flushes"
+            )
+
+    async def _fetch(self, edits: List[dict]) -> List[dict]:
+        # user long poll edits have neither the author nor the attachments, one getById call per 100 of them
+        complete = [edit for edit in edits if 'from_id' in edit]
+        ids = [edit['id'] for edit in edits if 'from_id' not in edit]
+        for i in range(0, len(ids), 100):
+            complete.extend((await self._api.method("messages.getById", message_ids=ids[i:i + 100]))['items'])
+        return complete
+
+    async def flush(self) -> int:
+        if not len(self):
+            return 0
+        messages, self._messages = self._messages, []
+        edits, self._edits = self._edits, []
+        deletions, self._deletions = self._deletions, []
+        registry.set("logger_live_queue_size", 0)
+        started_at = time.perf_counter()
+        written = 0
+        # every chat and every stage is written on its own, a failure puts back only its own events
+        stored: List[dict] = []
+        by_chat: Dict[int, List[dict]] = {}
+        for message in messages:
+            by_chat.setdefault(message['peer_id'], []).append(message)
+        try:
+            chats = await Chat.get_or_create_many_from_vk(self._api, by_chat) if by_chat else {}
+        except Exception as ex:
+            self._failed("message", messages, self._messages, ex)
+            chats = {}
+        for peer_id, chat_messages in by_chat.items():
+            if peer_id not in chats:
+                continue
+            try:
+                # bulk_parse expects a history page, newest first
+                written += await Message.bulk_parse(
+                    self._api, chat_messages[::-1], Message.TypeEnum.NEW_MESSAGE, chats[peer_id]
+                )
+            except Exception as ex:
+                self._failed("message", chat_messages, self._messages, ex)
+            else:
+                self._done("message", chat_messages)
+                stored += chat_messages
+
+        try:
+            edits = await self._fetch(edits)
+        except Exception as ex:
+            self._failed("edit", edits, self._edits, ex)
+            edits = []
+        if edits or deletions:
+            try:
+                # originals first, so deleting a message from the same batch finds it
+                written += await Message.record_changes(self._api, edits, deletions)
+            except Exception as ex:
+                self._failed("edit", edits, self._edits, ex)
+                self._failed("deletion", deletions, self._deletions, ex)
+            else:
+                self._done("edit", edits)
+                self._done("deletion", deletions)
+        registry.observe("logger_live_flush_seconds", time.perf_counter() - started_at)
+        registry.set("logger_live_queue_size", len(self))
+
+        registry.inc("logger_ingest_messages_total", len(stored))
+        if self._prerender and stored:
+            try:
+                await renderer.prerender(await Message.filter(
+                    message_id__in=[message['id'] for message in stored],
+                    type=Message.TypeEnum.NEW_MESSAGE
+                ))
+            except Exception as ex:
+                logger.exception(ex)
+        logger.opt(colors=True).debug(
+            f"Flushed <green>{len(stored)}</green> new, <green>{len(edits)}</green> edited, "
+            f"<green>{len(deletions)}</green> deleted messages, <red>{len(self)}</red> left for a retry"
+        )
+        return written
@@ -1,20 +1,24 @@
 import asyncio
 import threading
 import time
-from typing import List
+from typing import AsyncIterable, Callable, List, Type
 
 import vkquick
 import vkquick as vq
 
-from tortoise_models import init_tortoise, Message, Chat, Author
+from instrumentation import registry
+from logger_client.fetchers import DirectFetcher, ExecuteFetcher
+from logger_client.scheduler import ConversationScheduler, HistoryPage, InstrumentedAPI, save_page
+from tortoise_models import init_tortoise, Chat, Author, ChatCheckpoint
 from loguru import logger
 
 
 class ConversationGenerator:
 
-    def __init__(self, api: vq.API, filter_group: List[str]):
+    def __init__(self, api: vq.API, filter_group: List[str], fetcher: DirectFetcher = None):
         self._api = api
         self._filter_group = filter_group
+        self._fetcher = fetcher or DirectFetcher(api)
 
     async def __aiter__(self):
         conversations = await self._api.method("messages.getConversations", count=1)
@@ -22,26 +26,43 @@ class ConversationGenerator:
         count = conversations['count']
         while offset < count:
             try:
-                conversations = await self._api.method("messages.getConversations", offset=offset, count=200)
-                for conv in conversations['items']:
-                    if conv['conversation']['peer']['type'] not in self._filter_group or (
-                            self._filter_group[0] == 'peer_id' and
-                            conv['conversation']['peer']['id'] not in self._filter_group[0]
-                    ):
-                        continue
-                    yield conv['conversation']['peer']['id']
-                offset += len(conversations['items'])
+                requests = [
+                    {"offset": page_offset, "count": 200}
+                    for page_offset in range(offset, count, 200)
+                ][:self._fetcher.batch_size]
+                pages = await self._fetcher.fetch("messages.getConversations", requests)
+                for conversations in pages:
+                    for conv in conversations['items']:
+                        if conv['conversation']['peer']['type'] not in self._filter_group or (
+                                self._filter_group[0] == 'peer_id' and
+                                conv['conversation']['peer']['id'] not in self._filter_group[0]
+                        ):
+                            continue
+                        yield conv['conversation']['peer']['id']
+                if not pages[-1]['items']:
+                    break
+                offset = requests[-1]['offset'] + len(pages[-1]['items'])
             except Exception as ex:
+                registry.inc("logger_ingest_errors_total", stage="conversations")
                 logger.error(f"{ex}: sleep 5 second")
                 await asyncio.sleep(5)
 
 
 class HistoryGenerator:
 
-    def __init__(self, api: vq.API, conversation_peer_id: int, conv_name: str):
+    def __init__(
+            self,
+            api: vq.API,
+            conversation_peer_id: int,
+            conv_name: str,
+            delay: float = 2,
+            fetcher: DirectFetcher = None
+    ):
         self._api = api
         self._peer_id = conversation_peer_id
         self.conv_name = conv_name
+        self._delay = delay
+        self._fetcher = fetcher or DirectFetcher(api)
 
     async def get_list(self):
         messages = []
@@ -50,7 +71,15 @@ class HistoryGenerator:
         return messages
 
     async def __aiter__(self):
-        await asyncio.sleep(2)
+        async for page in self.pages():
+            for message in page:
+                # if message['date'] < time.time() - 24 * 60 * 60:
+                #     return
+                yield message
+
+    async def pages(self):
+        if self._delay:
+            await asyncio.sleep(self._delay)
         hist = await self._api.method("messages.getHistory", peer_id=self._peer_id, count=0)
         offset = 0
         hist_count = hist['count']
@@ -61,24 +90,126 @@ class HistoryGenerator:
                 f"<green>{offset}</green>/<green>{hist_count}</green>"
             )
             try:
-                hist = await self._api.method(
-                    "messages.getHistory",
-                    peer_id=self._peer_id,
-                    count=200,
-                    offset=offset
-                )
-                for message in hist['items']:
-                    # if message['date'] < time.time() - 24 * 60 * 60:
-                    #     return
-                    yield message
-                offset += len(hist['items'])
+                requests = [
+                    {"peer_id": self._peer_id, "count": 200, "offset": page_offset}
+                    for page_offset in range(offset, hist_count, 200)
+                ][:self._fetcher.batch_size]
+                pages = await self._fetcher.fetch("messages.getHistory", requests)
+                for hist in pages:
+                    if hist['items']:
+                        yield hist['items']
+                if not pages[-1]['items']:
+                    break
+                offset = requests[-1]['offset'] + len(pages[-1]['items'])
             except Exception as ex:
+                registry.inc("logger_ingest_errors_total", stage="history")
                 logger.error(f"{ex}: sleep 5 second")
                 await asyncio.sleep(.5)
 
 
-async def load_messages(api: vq.API):
+class IncrementalHistoryGenerator(HistoryGenerator):
+
+    def __init__(
+            self,
+            api: vq.API,
+            chat: Chat,
+            checkpoint: ChatCheckpoint,
+            delay: float = 2,
+            fetcher: DirectFetcher = None
+    ):
+        super().__init__(api, chat.id, chat.title, delay, fetcher)
+        self._checkpoint = checkpoint
+
+    async def pages(self):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        last_message_id = self._checkpoint.last_message_id
+        pass_newest_id = self._checkpoint.pass_newest_id
+        start_message_id = None
+        loaded = 0
+
+        while True:
+            params = {"peer_id": self._peer_id, "count": 200}
+            if start_message_id:
+                params["start_message_id"] = start_message_id
+            try:
+                hist = (await self._fetcher.fetch("messages.getHistory", [params]))[0]
+            except Exception as ex:
+                registry.inc("logger_ingest_errors_total", stage="history")
+                logger.error(f"{ex}: sleep 5 second")
+                await asyncio.sleep(.5)
+                continue
+
+            items = [msg for msg in hist['items'] if not start_message_id or msg['id'] < start_message_id]
+            if not items:
+                return
+            page = [
+                msg for msg in items
+                if msg['id'] > last_message_id and (pass_newest_id is None or msg['id'] > pass_newest_id)
+            ]
+            if page:
+                loaded += len(page)
+                logger.opt(colors=True).info(
+                    f"Sync conversation <red>{self.conv_name}</red>: <green>{loaded}</green> new messages"
+                )
+                yield page
+            if len(page) == len(items):
+                start_message_id = items[-1]['id']
+            elif pass_newest_id is not None and items[len(page)]['id'] <= pass_newest_id:
+                # reached the part stored by an interrupted run, continue below it
+                start_message_id = self._checkpoint.pass_oldest_id
+                pass_newest_id = None
+            else:
+                return
+
+
+class Throughput:
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.count = 0
+
+    def add(self, count: int):
+        self.count += count
+        registry.inc("logger_ingest_messages_total", count)
+
+    @property
+    def rate(self) -> float:
+        return self.count / max(time.monotonic() - self.started_at, 1e-9)
+
+
+async def _load_sequentially(
+        api: vq.API,
+        filter_group: List[str],
+        bulk: bool,
+        history: Callable[[vq.API, Chat, ChatCheckpoint], AsyncIterable[List[dict]]],
+        fetcher_cls: Type[DirectFetcher],
+        throughput: Throughput,
+        prerender: bool = False
+):
+    async for conversation_peer_id in ConversationGenerator(api, filter_group, fetcher_cls(api)):
+        chat = await Chat.get_or_create_from_vk(api, conversation_peer_id)
+        checkpoint = await ChatCheckpoint.for_chat(chat)
+        async for page in history(api, chat, checkpoint):
+            await save_page(api, HistoryPage(chat, page, checkpoint), bulk, throughput, prerender)
+            logger.opt(colors=True).info(
+                f"Processed <green>{throughput.count}</green> messages: "
+                f"<green>{throughput.rate:.1f}</green> msg/s"
+            )
+        await save_page(api, HistoryPage(chat, [], checkpoint, done=True), bulk, throughput)
+
+
+async def load_messages(
+        api: vq.API,
+        bulk: bool = False,
+        concurrency: int = 1,
+        requests_per_second: float = 3,
+        execute: bool = False,
+        incremental: bool = False,
+        prerender: bool = False
+):
     await init_tortoise()
+    api = InstrumentedAPI(api)
 
     filt = input("filter by [user, chat, group, email, all, peer_id[,peer_id[,peer_id[,...]]]]")
     if filt == 'all':
@@ -86,10 +217,37 @@ async def load_messages(api: vq.API):
     else:
         filter_group = [filt]
 
-    async for conversation_peer_id in ConversationGenerator(api, filter_group):
-        chat = await Chat.get_or_create_from_vk(api, conversation_peer_id)
-        async for msg in HistoryGenerator(api, chat.id, chat.title):
-            try:
-                await Message.parse_or_get(api, msg, Message.TypeEnum.NEW_MESSAGE, chat=chat)
-            except Exception as ex:
-                logger.exception(ex)
\ No newline at end of file
+    fetcher_cls = ExecuteFetcher if execute else DirectFetcher
+    delay = 0 if concurrency > 1 else 2
+
+    def history(history_api: vq.API, chat: Chat, checkpoint: ChatCheckpoint):
+        if incremental:
+            return IncrementalHistoryGenerator(
+                history_api, chat, checkpoint, delay=delay, fetcher=fetcher_cls(history_api)
+            ).pages()
+        return HistoryGenerator(
+            history_api, chat.id, chat.title, delay=delay, fetcher=fetcher_cls(history_api)
+        ).pages()
+
+    throughput = Throughput()
+    if concurrency > 1:
+        scheduler = ConversationScheduler(
+            api,
+            history,
+            concurrency=concurrency,
+            requests_per_second=requests_per_second,
+            bulk=bulk,
+            prerender=prerender
+        )
+        await scheduler.run(
+            ConversationGenerator(scheduler.api, filter_group, fetcher_cls(scheduler.api)),
+            throughput
+        )
+    else:
+        await _load_sequentially(api, filter_group, bulk, history, fetcher_cls, throughput, prerender)
+
+    logger.opt(colors=True).info(
+        f"Done: <green>{throughput.count}</green> messages in "
+        f"<green>{time.monotonic() - throughput.started_at:.1f}</green> s "
+        f"(<green>{throughput.rate:.1f}</green> msg/s)"
+    )
@@ -0,0 +1,139 @@
+import asyncio
+import datetime
+import hashlib
+import mimetypes
+import os
+import posixpath
+import urllib.parse
+import uuid
+from typing import List, Tuple
+
+import aiohttp
+from loguru import logger
+from tortoise.expressions import F
+
+import tortoise_models
+from logger_client.scheduler import TokenBucket
+from tortoise_models import Author, Chat, ChatStats, MediaFile, Message, RenderedMessage
+
+
+class MediaMirror:
+
+    def __init__(
+            self,
+            connections: int = 8,
+            requests_per_second: float = 20,
+            max_attempts: int = 3,
+            chunk_size: int = 500,
+            timeout: float = 60
+    ):
+        self._connections = connections
+        self._limiter = TokenBucket(requests_per_second)
+        self._max_attempts = max_attempts
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+
+    async def register(self) -> int:
+        # collects every picture the pages show, already known urls are skipped
+        registered = await MediaFile.register(
+            [photo for photo in await Author.all().values_list('photo', flat=True)]
+            + [photo for photo in await Chat.all().values_list('photo', flat=True)]
+        )
+        last_id = None
+        while True:
+            qs = Message.all().order_by('id').limit(self._chunk_size)
+            if last_id:
+                qs = qs.filter(id__gt=last_id)
+            messages = await qs
+            if not messages:
+                break
+            urls = []
+            for message in messages:
+                urls.extend(tortoise_models.media_urls(message.attachments))
+                for fwd_msg in message.fwd_messages:
+                    urls.extend(tortoise_models.message_media_urls(fwd_msg))
+            registered += await MediaFile.register(urls)
+            last_id = messages[-1].id
+        logger.opt(colors=True).info(f"Registered <green>{registered}</green> new media urls")
+        return registered
+
+    async def download_pending(self) -> Tuple[int, int]:
+        downloaded = failed = 0
+        os.makedirs(os.path.join(tortoise_models.media_dir, 'tmp'), exist_ok=True)
+        connector = aiohttp.TCPConnector(limit=self._connections)
+        timeout = aiohttp.ClientTimeout(total=self._timeout)
+        # the semaphore keeps queued files from spending their timeout waiting for a pooled connection
+        slots = asyncio.Semaphore(self._connections)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            last_id = 0
+            while True:
+                # finished files are never picked up again, so an interrupted run simply continues
+                pending: List[MediaFile] = await MediaFile.filter(
+                    id__gt=last_id, path=None, attempts__lt=self._max_attempts
+                ).order_by('id').limit(self._chunk_size)
+                if not pending:
+                    break
+                results = await asyncio.gather(*(self._download(session, slots, media) for media in pending))
+                downloaded += sum(results)
+                failed += len(results) - sum(results)
+                last_id = pending[-1].id
+                logger.opt(colors=True).info(
+                    f"Downloaded <green>{downloaded}</green> files, <red>{failed}</red> failed"
+                )
+        return downloaded, failed
+
+    async def _download(self, session: aiohttp.ClientSession, slots: asyncio.Semaphore, media: MediaFile) -> bool:
+        async with slots:
+            await self._limiter.acquire()
+            return await self._fetch(session, media)
+
+    async def _fetch(self, session: aiohttp.ClientSession, media: MediaFile) -> bool:
+        tmp_path = os.path.join(tortoise_models.media_dir, 'tmp', uuid.uuid4().hex)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            async with session.get(media.url) as response:
+                response.raise_for_status()
+                content_type = response.content_type
+                with open(tmp_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+        except Exception as ex:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            await MediaFile.filter(id=media.id).update(attempts=F('attempts') + 1, error=f"{type(ex).__name__}: {ex}")
+            logger.warning(f"{media.url}: {type(ex).__name__}: {ex}")
+            return False
+
+        name = digest.hexdigest()
+        path = f"{name[:2]}/{name}{self._extension(media.url, content_type)}"
+        full_path = os.path.join(tortoise_models.media_dir, *path.split('/'))
+        if os.path.exists(full_path):
+            # the same sticker or avatar behind another url
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(tmp_path, full_path)
+        await MediaFile.filter(id=media.id).update(path=path, content_type=content_type, size=size, error=None)
+        return True
+
+    @staticmethod
+    def _extension(url: str, content_type: str) -> str:
+        extension = posixpath.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+        if 1 < len(extension) <= 5 and extension[1:].isalnum():
+            return extension
+        return mimetypes.guess_extension(content_type or '') or ''
+
+    async def run(self) -> Tuple[int, int]:
+        await self.register()
+        downloaded, failed = await self.download_pending()
+        if downloaded:
+            # prerendered fragments and cached pages still point at vk, render them again
+            await RenderedMessage.all().delete()
+            await ChatStats.all().update(updated_at=datetime.datetime.utcnow())
+            logger.opt(colors=True).info(
+                "Prerendered messages were dropped, run <green>python -m logger_client prerender</green> to restore them"
+            )
+        return downloaded, failed
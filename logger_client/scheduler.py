@@ -0,0 +1,186 @@
+import asyncio
+import dataclasses
+import time
+from typing import AsyncIterable, Callable, List, Optional
+
+import vkquick as vq
+from loguru import logger
+
+from instrumentation import registry
+from logger_server import renderer
+from tortoise_models import Chat, ChatCheckpoint, Message
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class InstrumentedAPI:
+    # times every VK call and counts failures by error code, the rest is the wrapped api
+
+    def __init__(self, api: vq.API):
+        self.api = api
+
+    def __getattr__(self, name: str):
+        return getattr(self.api, name)
+
+    def use_cache(self) -> "InstrumentedAPI":
+        return InstrumentedAPI(self.api.use_cache())
+
+    async def method(self, name: str, **params):
+        started_at = time.perf_counter()
+        try:
+            return await self.api.method(name, **params)
+        except Exception as ex:
+            registry.inc("logger_vk_api_errors_total", method=name, code=getattr(ex, 'code', 'unknown'))
+            raise
+        finally:
+            registry.observe("logger_vk_api_seconds", time.perf_counter() - started_at, method=name)
+
+
+class RateLimitedAPI:
+    # 6 - too many requests per second, 9 - flood control, 29 - rate limit reached
+    RATE_LIMIT_CODES = (6, 9, 29)
+
+    def __init__(self, api: vq.API, limiter: TokenBucket, min_backoff: float = .5, max_backoff: float = 60):
+        self.api = api
+        self._limiter = limiter
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff = 0.
+
+    def use_cache(self) -> "RateLimitedAPI":
+        api = RateLimitedAPI(self.api.use_cache(), self._limiter, self._min_backoff, self._max_backoff)
+        api._backoff = self._backoff
+        return api
+
+    async def method(self, name: str, **params):
+        while True:
+            await self._limiter.acquire()
+            try:
+                response = await self.api.method(name, **params)
+            except Exception as ex:
+                if getattr(ex, 'code', None) not in self.RATE_LIMIT_CODES:
+                    raise
+                self._backoff = min(max(self._backoff * 2, self._min_backoff), self._max_backoff)
+                registry.inc("logger_vk_api_retries_total", method=name)
+                logger.warning(f"{name}: rate limit ({ex}), backoff {self._backoff:.1f} s")
+                self._limiter.pause(self._backoff)
+                continue
+            self._backoff /= 2
+            return response
+
+
+@dataclasses.dataclass
+class HistoryPage:
+    chat: Chat
+    items: List[dict]
+    checkpoint: ChatCheckpoint
+    done: bool = False
+
+
+async def save_page(api: vq.API, page: HistoryPage, bulk: bool, throughput, prerender: bool = False):
+    try:
+        if bulk:
+            await Message.bulk_parse(api, page.items, Message.TypeEnum.NEW_MESSAGE, page.chat)
+        else:
+            for msg in page.items:
+                await Message.parse_or_get(api, msg, Message.TypeEnum.NEW_MESSAGE, chat=page.chat)
+        throughput.add(len(page.items))
+        await page.checkpoint.page_written(page.items)
+    except Exception as ex:
+        page.checkpoint.fail()
+        registry.inc("logger_ingest_errors_total", stage="save")
+        logger.exception(ex)
+    else:
+        if prerender and page.items:
+            try:
+                await renderer.prerender(await Message.filter(
+                    chat=page.chat,
+                    message_id__in=[msg['id'] for msg in page.items],
+                    type=Message.TypeEnum.NEW_MESSAGE
+                ))
+            except Exception as ex:
+                logger.exception(ex)
+    if page.done:
+        await page.checkpoint.finish()
+
+
+class ConversationScheduler:
+
+    def __init__(
+            self,
+            api: vq.API,
+            history: Callable[["RateLimitedAPI", Chat, ChatCheckpoint], AsyncIterable[List[dict]]],
+            concurrency: int = 4,
+            requests_per_second: float = 3,
+            queue_size: int = 16,
+            bulk: bool = True,
+            prerender: bool = False
+    ):
+        self.api = RateLimitedAPI(api, TokenBucket(requests_per_second))
+        self._history = history
+        self._concurrency = concurrency
+        self._pages: "asyncio.Queue[Optional[HistoryPage]]" = asyncio.Queue(maxsize=queue_size)
+        self._bulk = bulk
+        self._prerender = prerender
+
+    async def run(self, conversations: AsyncIterable[int], throughput):
+        peer_ids: "asyncio.Queue[Optional[int]]" = asyncio.Queue(maxsize=self._concurrency)
+        writer = asyncio.ensure_future(self._writer(throughput))
+        workers = [asyncio.ensure_future(self._worker(peer_ids)) for _ in range(self._concurrency)]
+
+        async for peer_id in conversations:
+            await peer_ids.put(peer_id)
+        for _ in workers:
+            await peer_ids.put(None)
+
+        await asyncio.gather(*workers)
+        await self._pages.put(None)
+        await writer
+
+    async def _worker(self, peer_ids: "asyncio.Queue[Optional[int]]"):
+        while (peer_id := await peer_ids.get()) is not None:
+            try:
+                chat = await Chat.get_or_create_from_vk(self.api, peer_id)
+                checkpoint = await ChatCheckpoint.for_chat(chat)
+                async for page in self._history(self.api, chat, checkpoint):
+                    await self._pages.put(HistoryPage(chat, page, checkpoint))
+                await self._pages.put(HistoryPage(chat, [], checkpoint, done=True))
+            except Exception as ex:
+                logger.exception(ex)
+
+    async def _writer(self, throughput):
+        while (page := await self._pages.get()) is not None:
+            await save_page(self.api, page, self._bulk, throughput, self._prerender)
+            if page.items:
+                logger.opt(colors=True).info(
+                    f"Processed <green>{throughput.count}</green> messages: "
+                    f"<green>{throughput.rate:.1f}</green> msg/s, "
+                    f"queue <green>{self._pages.qsize()}</green>"
+                )
@@ -1 +1,6 @@
-from logger_server.__main__ import app as application
+def __getattr__(name: str):
+    # the client imports the renderer from this package, the server app is only built when asked for
+    if name == "application":
+        from logger_server.__main__ import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,64 +1,217 @@
+import datetime
 import os
 import re
+import sys
+import urllib.parse
 
 from aiohttp import web
 from tortoise.query_utils import Q
 
 import tortoise_models
-from logger_server.renderer import ListOfChatsRenderer, LayoutRenderer
-from logger_server.utils import jinja2_env, prepare_text, Paginator
+from instrumentation import count_queries, stage
+from logger_server import api
+from logger_server.cache import page_cache, cache_headers, is_not_modified
+from logger_server.metrics import instrument, loop_lag, metrics
+from logger_server.renderer import ListOfChatsRenderer, LayoutRenderer, SearchRenderer, render_pool
+from logger_server.utils import jinja2_env, prepare_text, CursorPaginator, date_cursor
 
-app = web.Application()
+app = web.Application(middlewares=[instrument])
+
+SEARCH_PAGE_SIZE = 50
+CHAT_PAGE_SIZE = 200
+MAX_CHAT_PAGE_SIZE = 5000
+STREAM_CHUNK_SIZE = 50
+STREAM_PAGES = os.environ.get("LOGGER_STREAM_PAGES", "0") == "1"
+
+
+def _option(name: str, default: str) -> str:
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
 
 
 async def list_of_chats(request: web.Request) -> web.Response:
     if request.method == 'POST':
         data = await request.post()
         search_ph = data.get('searchPhrase', '')
-        chats = await tortoise_models.Chat.filter(title__icontains=search_ph)
+        with stage('db'):
+            chats = await tortoise_models.Chat.filter(title__icontains=search_ph)
     else:
         search_ph = ''
-        chats = await tortoise_models.Chat.all()
+        with stage('db'):
+            chats = await tortoise_models.Chat.all()
 
-    return web.Response(
-        text=await ListOfChatsRenderer().render(search_ph, *chats),
-        content_type='text/html'
-    )
+    text = await ListOfChatsRenderer().render(search_ph, *chats)
+    with stage('serialize'):
+        return web.Response(text=text, content_type='text/html')
 
 
-async def show_chat(request: web.Request) -> web.Response:
+async def show_chat(request: web.Request) -> web.StreamResponse:
+    data = dict(request.query)
     if request.method == 'POST':
-        data = await request.post()
-        search_ph = data.get('searchPhrase', '')
-        page = int(data.get('page', '1'))
-    else:
-        page = 1
-        search_ph = ''
-
-    chat = await tortoise_models.Chat.get(id=int(request.match_info['peer_id']))
-    qs = Q(chat=chat)
+        data.update(await request.post())
+    search_ph = data.get('searchPhrase', '')
     if search_ph:
-        qs &= Q(message_text__icontains=search_ph) | Q(author__title__icontains=search_ph)
+        raise web.HTTPFound('/search?' + urllib.parse.urlencode({
+            'q': search_ph,
+            'peer_id': request.match_info['peer_id']
+        }))
 
-    paginator = await Paginator.create(
-        tortoise_models.Message,
-        qs,
-        200,
-        page
-    )
-    return web.Response(
-        text=await LayoutRenderer().render(chat, paginator, search_ph),
-        content_type='text/html'
+    with stage('db'):
+        chat = await tortoise_models.Chat.get(id=int(request.match_info['peer_id']))
+        stats = await tortoise_models.ChatStats.get_or_none(chat=chat)
+    qs = Q(chat=chat, type=tortoise_models.Message.TypeEnum.NEW_MESSAGE)
+    try:
+        count = min(max(int(data.get('count', CHAT_PAGE_SIZE)), 1), MAX_CHAT_PAGE_SIZE)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad count {data['count']!r}, expected a number")
+    stream = data.get('stream', '1' if STREAM_PAGES else '0') == '1'
+    try:
+        day = datetime.date.fromisoformat(data['date']) if data.get('date') else None
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad date {data['date']!r}, expected YYYY-MM-DD")
+    try:
+        if data.get('cursor'):
+            CursorPaginator.decode_cursor(data['cursor'])
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad cursor {data['cursor']!r}")
+
+    last_modified = stats.updated_at if stats else None
+    version = page_cache.version(last_modified)
+    etag = page_cache.etag(chat.id, version, ('chat', data.get('cursor', ''), data.get('direction', 'next'), str(count),
+                                          data.get('stream', ''), str(day or '')))
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+
+    body = page_cache.get(chat.id, version, etag)
+    if body is not None:
+        return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+    query = {}
+    if count != CHAT_PAGE_SIZE:
+        query['count'] = str(count)
+    if 'stream' in data:
+        query['stream'] = data['stream']
+    cursor, direction = data.get('cursor'), data.get('direction', 'next')
+    with stage('db'):
+        if day:
+            cursor, direction = await date_cursor(chat.id, qs, day)
+        paginator = await CursorPaginator.create(
+            tortoise_models.Message,
+            qs,
+            count,
+            cursor=cursor,
+            direction=direction,
+            all_count=stats.message_count if stats else 0,
+            prefetch=('author',),
+            base_url=f"/{chat.id}",
+            query=query
+        )
+    if not stream:
+        text = await LayoutRenderer().render(chat, paginator, search_ph)
+        with stage('serialize'):
+            body = text.encode()
+            page_cache.set(chat.id, version, etag, body)
+            return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+    response = web.StreamResponse(headers=headers)
+    response.content_type = 'text/html'
+    response.charset = 'utf-8'
+    await response.prepare(request)
+    chunks = []
+    async for chunk in LayoutRenderer().stream(chat, paginator, search_ph, STREAM_CHUNK_SIZE):
+        with stage('serialize'):
+            chunks.append(chunk.encode())
+            await response.write(chunks[-1])
+    await response.write_eof()
+    page_cache.set(chat.id, version, etag, b"".join(chunks))
+    return response
+
+
+async def search(request: web.Request) -> web.Response:
+    search_ph = request.query.get('q', '')
+    try:
+        page = max(int(request.query.get('page', '1')), 1)
+        chat_id = int(request.query['peer_id']) if request.query.get('peer_id') else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="page and peer_id must be numbers")
+    chat = None
+    if chat_id:
+        with stage('db'):
+            chat = await tortoise_models.Chat.get(id=chat_id)
+
+    headers = {}
+    if chat:
+        with stage('db'):
+            stats = await tortoise_models.ChatStats.get_or_none(chat=chat)
+        last_modified = stats.updated_at if stats else None
+        version = page_cache.version(last_modified)
+        etag = page_cache.etag(chat.id, version, ('search', search_ph, str(page)))
+        headers = cache_headers(etag, last_modified)
+        if is_not_modified(request, etag, last_modified):
+            return web.Response(status=304, headers=headers)
+        body = page_cache.get(chat.id, version, etag)
+        if body is not None:
+            return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+    with stage('db'):
+        results = await tortoise_models.SearchIndex.search(
+            search_ph,
+            chat_id=chat.id if chat else None,
+            limit=SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * SEARCH_PAGE_SIZE
+        )
+    text = await SearchRenderer().render(
+        search_ph,
+        results[:SEARCH_PAGE_SIZE],
+        chat,
+        page,
+        len(results) > SEARCH_PAGE_SIZE
     )
+    with stage('serialize'):
+        body = text.encode()
+        if chat:
+            page_cache.set(chat.id, version, etag, body)
+        return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+
+async def init_database(app: web.Application):
+    # the server only reads, writes belong to the client
+    await tortoise_models.init_tortoise(read_only=True)
+    count_queries()
+
+
+async def media_cache_headers(request: web.Request, response: web.StreamResponse):
+    # mirrored files are named after their content and never change
+    if request.path.startswith(f"{tortoise_models.MEDIA_URL}/") and response.status == 200:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+
+async def shutdown_render_pool(app: web.Application):
+    if render_pool:
+        render_pool.shutdown()
 
 
+app.router.add_get('/metrics', metrics)
+api.setup(app)
+app.router.add_get('/search', search)
 app.router.add_get('/', list_of_chats)
 app.router.add_post('/', list_of_chats)
 app.router.add_get(r'/{peer_id}', show_chat)
 app.router.add_post(r'/{peer_id}', show_chat)
 
-app.on_startup.append(tortoise_models.init_tortoise)
+app.on_response_prepare.append(media_cache_headers)
+app.on_startup.append(init_database)
+app.on_startup.append(loop_lag.start)
+app.on_cleanup.append(loop_lag.stop)
+app.on_cleanup.append(shutdown_render_pool)
 
 if __name__ == "__main__":
+    tortoise_models.db_path = _option("--db", tortoise_models.db_path)
+    tortoise_models.database_url = _option("--db-url", tortoise_models.database_url)
     app.router.add_static('/static', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static'))
+    tortoise_models.media_dir = _option("--media-dir", tortoise_models.media_dir)
+    if os.path.isdir(tortoise_models.media_dir):
+        app.router.add_static(tortoise_models.MEDIA_URL, tortoise_models.media_dir)
     web.run_app(app)
@@ -0,0 +1,243 @@
+import datetime
+import typing
+
+from aiohttp import web
+from tortoise.query_utils import Q
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from instrumentation import stage
+from logger_server.cache import page_cache, cache_headers, is_not_modified
+from logger_server.renderer import ChatResult
+from logger_server.utils import CursorPaginator, date_cursor
+from tortoise_models import Author, Chat, ChatStats, MediaFile, Message, SearchIndex, json_dumps
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+SEARCH_PAGE_SIZE = 50
+MAX_AUTHOR_IDS = 500
+# smaller bodies are sent as they are, compressing them costs more than it saves
+COMPRESS_MIN_BYTES = 1024
+
+
+def json_response(request: web.Request, body: bytes, headers: typing.Dict[str, str] = None) -> web.Response:
+    response = web.Response(body=body, content_type='application/json', headers=headers)
+    if len(body) >= COMPRESS_MIN_BYTES:
+        response.headers['Vary'] = 'Accept-Encoding'
+        if brotli and 'br' in request.headers.get('Accept-Encoding', ''):
+            response.body = brotli.compress(body, quality=5)
+            response.headers['Content-Encoding'] = 'br'
+        else:
+            response.enable_compression()
+    return response
+
+
+def link_header(paginator: CursorPaginator[Message]) -> typing.Dict[str, str]:
+    # lets a client prefetch the neighbouring pages before it parses the body
+    links = []
+    if paginator.has_next:
+        links.append(f'<{paginator.next_url}>; rel="next"')
+    if paginator.has_prev:
+        links.append(f'<{paginator.prev_url}>; rel="prev"')
+    return {'Link': ", ".join(links)} if links else {}
+
+
+async def authors_json(author_ids: typing.Iterable[int]) -> typing.Dict[str, dict]:
+    # only the stored authors, a read request never calls VK or writes to the database
+    author_ids = set(author_ids)
+    authors = await Author.filter(id__in=author_ids) if author_ids else []
+    photos = await MediaFile.local_urls({author.photo for author in authors})
+    return {
+        str(author.id): dict(title=author.title, photo=photos.get(author.photo, author.photo), link=author.get_link())
+        for author in authors
+    }
+
+
+def message_json(message: Message, reply: bool = True) -> dict:
+    result = dict(
+        id=str(message.id),
+        message_id=message.message_id,
+        chat_id=message.chat_id,
+        author_id=message.author_id,
+        date=message.date.isoformat(),
+        text=message.message_text,
+        attachments=message.attachments,
+        fwd_messages=message.fwd_messages,
+        reply_message_id=str(message.reply_message_id) if message.reply_message_id else None,
+        edits=[
+            dict(date=change.date.isoformat(), text=change.message_text)
+            for change in message._changes
+            if change.type == Message.TypeEnum.EDIT_MESSAGE
+        ],
+        deleted=next((
+            change.date.isoformat()
+            for change in message._changes
+            if change.type == Message.TypeEnum.DELETE_MESSAGE
+        ), None)
+    )
+    if reply:
+        # the relation is None when prefetched empty and awaitable when never fetched
+        replied = message.reply_message if message.reply_message_id else None
+        result['reply_message'] = message_json(replied, reply=False) if isinstance(replied, Message) else None
+    return result
+
+
+async def messages_json(messages: typing.List[Message]) -> dict:
+    # every author is sent once per response, messages refer to them by id
+    await Message.prefetch_replies(messages, max_depth=1)
+    await Message.prefetch_changes(messages)
+    items = [message_json(message) for message in messages]
+    author_ids = set()
+    for message in messages:
+        # a reply is sent with its own forwards, their authors are listed too
+        shown = [message, message.reply_message] if isinstance(message.reply_message, Message) else [message]
+        for item in shown:
+            author_ids.add(item.author_id)
+            for fwd_msg in item.fwd_messages:
+                author_ids |= Message.collect_author_ids(fwd_msg)
+    return dict(items=await MediaFile.localize(items), authors=await authors_json(author_ids))
+
+
+async def chats(request: web.Request) -> web.Response:
+    with stage('db'):
+        latest = await ChatStats.all().order_by('-updated_at').first()
+    last_modified = latest.updated_at if latest else None
+    version = page_cache.version(last_modified)
+    etag = page_cache.etag(0, version, ('api', 'chats'))
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+    body = page_cache.get(0, version, etag)
+    if body is None:
+        with stage('db'):
+            results = await ChatResult.gen_many(await Chat.all())
+            photos = await MediaFile.local_urls({result.chat.photo for result in results})
+        results.sort(key=lambda result: result.last_message_date.timestamp() if result.last_message_date else 0,
+                     reverse=True)
+        with stage('serialize'):
+            body = json_dumps(dict(chats=[
+                dict(
+                    id=result.chat.id,
+                    title=result.chat.title,
+                    photo=photos.get(result.chat.photo, result.chat.photo),
+                    message_count=result.count,
+                    last_message_date=result.last_message_date.isoformat() if result.last_message_date else None,
+                    last_message_preview=result.last_message_preview
+                )
+                for result in results
+            ]))
+            page_cache.set(0, version, etag, body)
+    return json_response(request, body, headers)
+
+
+async def chat_messages(request: web.Request) -> web.Response:
+    data = request.query
+    with stage('db'):
+        chat = await Chat.get_or_none(id=int(request.match_info['peer_id']))
+        if chat is None:
+            raise web.HTTPNotFound()
+        stats = await ChatStats.get_or_none(chat=chat)
+    try:
+        count = min(max(int(data.get('count', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad count {data['count']!r}, expected a number")
+    try:
+        day = datetime.date.fromisoformat(data['date']) if data.get('date') else None
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad date {data['date']!r}, expected YYYY-MM-DD")
+    try:
+        if data.get('cursor'):
+            CursorPaginator.decode_cursor(data['cursor'])
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Bad cursor {data['cursor']!r}")
+
+    last_modified = stats.updated_at if stats else None
+    version = page_cache.version(last_modified)
+    etag = page_cache.etag(chat.id, version, ('api', data.get('cursor', ''), data.get('direction', 'next'), str(count),
+                                              str(day or '')))
+    headers = cache_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+    body = page_cache.get(chat.id, version, etag)
+    if body is not None:
+        return json_response(request, body, headers)
+
+    qs = Q(chat=chat, type=Message.TypeEnum.NEW_MESSAGE)
+    cursor, direction = data.get('cursor'), data.get('direction', 'next')
+    with stage('db'):
+        if day:
+            cursor, direction = await date_cursor(chat.id, qs, day)
+        paginator = await CursorPaginator.create(
+            Message,
+            qs,
+            count,
+            cursor=cursor,
+            direction=direction,
+            all_count=stats.message_count if stats else 0,
+            base_url=f"/api/chats/{chat.id}/messages",
+            query={'count': str(count)} if count != PAGE_SIZE else {}
+        )
+        page = await messages_json(paginator.items)
+    headers.update(link_header(paginator))
+    with stage('serialize'):
+        body = json_dumps(dict(
+            chat=dict(id=chat.id, title=chat.title),
+            all_count=paginator.all_count,
+            **page,
+            next=paginator.next_url if paginator.has_next else None,
+            prev=paginator.prev_url if paginator.has_prev else None
+        ))
+        page_cache.set(chat.id, version, etag, body)
+    return json_response(request, body, headers)
+
+
+async def search(request: web.Request) -> web.Response:
+    phrase = request.query.get('q', '')
+    try:
+        page = max(int(request.query.get('page', '1')), 1)
+        chat_id = int(request.query['peer_id']) if request.query.get('peer_id') else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="page and peer_id must be numbers")
+    with stage('db'):
+        results = await SearchIndex.search(
+            phrase,
+            chat_id=chat_id,
+            limit=SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * SEARCH_PAGE_SIZE
+        )
+        messages = {
+            str(message.id): message
+            for message in await Message.filter(id__in=[result.message_id for result in results[:SEARCH_PAGE_SIZE]])
+        }
+        found = [result for result in results[:SEARCH_PAGE_SIZE] if result.message_id in messages]
+        response = await messages_json([messages[result.message_id] for result in found])
+    for item, result in zip(response['items'], found):
+        # html-escaped text with the matches wrapped in <mark>
+        item['snippet'] = result.snippet
+    with stage('serialize'):
+        body = json_dumps(dict(**response, page=page, has_next=len(results) > SEARCH_PAGE_SIZE))
+    return json_response(request, body)
+
+
+async def authors(request: web.Request) -> web.Response:
+    try:
+        author_ids = [int(author_id) for author_id in request.query.get('ids', '').split(',') if author_id]
+    except ValueError:
+        raise web.HTTPBadRequest(text="ids must be comma separated numbers")
+    if len(author_ids) > MAX_AUTHOR_IDS:
+        raise web.HTTPBadRequest(text=f"At most {MAX_AUTHOR_IDS} ids per request")
+    with stage('db'):
+        result = await authors_json(author_ids)
+    with stage('serialize'):
+        body = json_dumps(dict(authors=result))
+    return json_response(request, body)
+
+
+def setup(app: web.Application):
+    app.router.add_get('/api/chats', chats)
+    app.router.add_get(r'/api/chats/{peer_id:-?\d+}/messages', chat_messages)
+    app.router.add_get('/api/search', search)
+    app.router.add_get('/api/authors', authors)
@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+import os
+import shutil
+import typing
+
+from aiohttp import web
+from cachetools import LRUCache
+
+from logger_server.renderer import TEMPLATES_VERSION
+
+
+class PageCache:
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, directory: typing.Optional[str] = None):
+        self._memory: LRUCache = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self._keys: typing.Dict[int, typing.Set[str]] = {}
+        self._versions: typing.Dict[int, str] = {}
+        self._directory = directory
+
+    @staticmethod
+    def version(updated_at: typing.Optional[datetime.datetime]) -> str:
+        # a template deploy changes every page, so it changes the etags and the cache directories too
+        return f"{TEMPLATES_VERSION}:{updated_at.isoformat() if updated_at else ''}"
+
+    @staticmethod
+    def etag(chat_id: int, version: str, key: typing.Tuple[str, ...]) -> str:
+        return hashlib.sha1(repr((chat_id, version, key)).encode()).hexdigest()
+
+    def _path(self, chat_id: int, version: str, etag: str) -> str:
+        return os.path.join(self._directory, str(chat_id), hashlib.sha1(version.encode()).hexdigest(), etag)
+
+    def _invalidate_stale(self, chat_id: int, version: str):
+        if self._versions.get(chat_id) == version:
+            return
+        for etag in self._keys.pop(chat_id, set()):
+            self._memory.pop(etag, None)
+        if self._directory and os.path.isdir(os.path.join(self._directory, str(chat_id))):
+            current = hashlib.sha1(version.encode()).hexdigest()
+            for name in os.listdir(os.path.join(self._directory, str(chat_id))):
+                if name != current:
+                    shutil.rmtree(os.path.join(self._directory, str(chat_id), name), ignore_errors=True)
+        self._versions[chat_id] = version
+
+    def get(self, chat_id: int, version: str, etag: str) -> typing.Optional[bytes]:
+        self._invalidate_stale(chat_id, version)
+        body = self._memory.get(etag)
+        if body is None and self._directory:
+            try:
+                with open(self._path(chat_id, version, etag), 'rb') as f:
+                    body = f.read()
+            except FileNotFoundError:
+                return None
+            self._remember(chat_id, etag, body)
+        return body
+
+    def set(self, chat_id: int, version: str, etag: str, body: bytes):
+        self._invalidate_stale(chat_id, version)
+        self._remember(chat_id, etag, body)
+        if self._directory:
+            path = self._path(chat_id, version, etag)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(body)
+            os.replace(f"{path}.tmp", path)
+
+    def _remember(self, chat_id: int, etag: str, body: bytes):
+        if len(body) <= self._memory.maxsize:
+            self._memory[etag] = body
+            self._keys.setdefault(chat_id, set()).add(etag)
+
+
+def _utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def cache_headers(etag: str, last_modified: typing.Optional[datetime.datetime]) -> typing.Dict[str, str]:
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if last_modified:
+        headers['Last-Modified'] = _utc(last_modified).strftime('%a, %d %b %Y %H:%M:%S GMT')
+    return headers
+
+
+def is_not_modified(request: web.Request, etag: str, last_modified: typing.Optional[datetime.datetime]) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return f'"{etag}"' in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if last_modified and request.if_modified_since:
+        return _utc(last_modified).replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+page_cache = PageCache(
+    max_bytes=int(os.environ.get("LOGGER_PAGE_CACHE_MB", "64")) * 1024 * 1024,
+    directory=os.environ.get("LOGGER_PAGE_CACHE_DIR")
+)
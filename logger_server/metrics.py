@@ -0,0 +1,134 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import time
+import typing
+
+from aiohttp import web
+from loguru import logger
+
+from instrumentation import RequestStats, count_queries, current_request, registry
+
+
+class LoopLagMonitor:
+
+    def __init__(self, interval: float = .5, warn_threshold: float = .2):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.lag = 0.
+        self.max_lag = 0.
+        self.stalls = 0
+        self._task: typing.Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lag = max(time.monotonic() - started_at - self.interval, 0.)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.lag >= self.warn_threshold:
+                self.stalls += 1
+                logger.warning(f"Event loop was blocked for {self.lag:.3f} s")
+
+    async def start(self, app: web.Application):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, app: web.Application):
+        if self._task:
+            self._task.cancel()
+
+    def render(self) -> str:
+        return (
+            "# TYPE logger_event_loop_lag_seconds gauge\n"
+            f"logger_event_loop_lag_seconds {self.lag:.6f}\n"
+            "# TYPE logger_event_loop_lag_max_seconds gauge\n"
+            f"logger_event_loop_lag_max_seconds {self.max_lag:.6f}\n"
+            "# TYPE logger_event_loop_stalls_total counter\n"
+            f"logger_event_loop_stalls_total {self.stalls}\n"
+        )
+
+
+loop_lag = LoopLagMonitor(
+    warn_threshold=float(os.environ.get("LOGGER_LOOP_LAG_WARN", "0.2"))
+)
+
+
+# ?profile=1 answers with a cProfile report instead of the page, only when enabled
+PROFILE_REQUESTS = os.environ.get("LOGGER_PROFILE", "0") == "1"
+STAGES = ('db', 'render', 'serialize')
+
+
+def server_timing(stats: RequestStats, total: float) -> str:
+    timings = [f"{name};dur={stats.stages[name] * 1000:.1f}" for name in STAGES if name in stats.stages]
+    return ", ".join([*timings, f"total;dur={total * 1000:.1f}", f'sql;desc="{stats.queries} queries"'])
+
+
+def profile_report(profile: cProfile.Profile, stats: RequestStats, total: float, limit: int = 40) -> str:
+    output = io.StringIO()
+    output.write(f"total {total * 1000:.1f} ms, {stats.queries} queries\n")
+    for name, seconds in stats.stages.items():
+        output.write(f"{name} {seconds * 1000:.1f} ms\n")
+    output.write("\n")
+    pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(limit)
+    return output.getvalue()
+
+
+@web.middleware
+async def instrument(request: web.Request, handler) -> web.StreamResponse:
+    resource = request.match_info.route.resource
+    name = resource.canonical if resource is not None else "unmatched"
+    stats = RequestStats()
+    token = current_request.set(stats)
+    profile = cProfile.Profile() if PROFILE_REQUESTS and request.query.get('profile') == '1' else None
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        if profile:
+            # counts everything the loop runs meanwhile, meant for one request on an idle server
+            profile.enable()
+        try:
+            response = await handler(request)
+        finally:
+            if profile:
+                profile.disable()
+        status = response.status
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        total = time.perf_counter() - started_at
+        current_request.reset(token)
+        registry.inc("logger_http_requests_total", handler=name, status=status)
+        registry.observe("logger_http_request_seconds", total, handler=name)
+        registry.observe("logger_http_request_queries", stats.queries, handler=name)
+        for stage_name, seconds in stats.stages.items():
+            registry.observe("logger_http_request_stage_seconds", seconds, handler=name, stage=stage_name)
+
+    if profile:
+        report = profile_report(profile, stats, total)
+        if not response.prepared:
+            return web.Response(text=report, content_type='text/plain')
+        logger.info(f"Profile of {request.path_qs}\n{report}")
+    elif not response.prepared:
+        response.headers['Server-Timing'] = server_timing(stats, total)
+    return response
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render() + loop_lag.render(), content_type='text/plain')
+
+
+async def serve(port: int) -> web.AppRunner:
+    # the client has no web server of its own, this one only answers /metrics
+    count_queries()
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    app.on_startup.append(loop_lag.start)
+    app.on_cleanup.append(loop_lag.stop)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logger.info(f"Metrics are served on http://localhost:{port}/metrics")
+    return runner
@@ -1,12 +1,19 @@
 import abc
+import asyncio
+import concurrent.futures
 import dataclasses
 import datetime
+import hashlib
+import os
 import typing
+import urllib.parse
 
-from jinja2 import Template
+from jinja2 import Template, TemplateNotFound
+from loguru import logger
 
 import tortoise_models
-from logger_server.utils import jinja2_env, prepare_text, api, Paginator
+from instrumentation import stage
+from logger_server.utils import jinja2_env, prepare_text, api, CursorPaginator
 from tortoise_models import Message
 
 
@@ -28,11 +35,14 @@ class ABCRenderer(abc.ABC):
 
 
 class BaseRenderer(ABCRenderer):
+    _templates: typing.Dict[str, Template] = {}
 
     def get_template(self) -> Template:
         if isinstance(self.template, Template):
             return self.template
-        return jinja2_env.get_template(self.template)
+        if self.template not in BaseRenderer._templates:
+            BaseRenderer._templates[self.template] = jinja2_env.get_template(self.template)
+        return BaseRenderer._templates[self.template]
 
     async def render(self, message: Message) -> str:
         fields = {}
@@ -45,28 +55,48 @@ class BaseRenderer(ABCRenderer):
 class ChatResult:
     chat: tortoise_models.Chat
     count: int
+    last_message_date: typing.Optional[datetime.datetime] = None
+    last_message_preview: str = ""
 
     @classmethod
-    async def gen(cls, chat: tortoise_models.Chat):
-        return cls(
-            chat,
-            await chat.messages.all().count()
-        )
+    async def gen_many(cls, chats: typing.Iterable[tortoise_models.Chat]) -> typing.List["ChatResult"]:
+        chats = list(chats)
+        stats = {
+            stats.chat_id: stats
+            for stats in await tortoise_models.ChatStats.filter(chat_id__in=[chat.id for chat in chats])
+        } if chats else {}
+        return [
+            cls(
+                chat,
+                stats[chat.id].message_count,
+                stats[chat.id].last_message_date,
+                stats[chat.id].last_message_preview
+            ) if chat.id in stats else cls(chat, 0)
+            for chat in chats
+        ]
 
 
 class ListOfChatsRenderer(BaseRenderer):
     template = 'list_of_chats.html'
 
     async def render(self, search_phrase: str, *chats: tortoise_models.Chat) -> str:
-        new_chats = []
+        with stage('db'):
+            photos = await tortoise_models.MediaFile.local_urls({chat.photo for chat in chats})
+            results = await ChatResult.gen_many(chats)
         for chat in chats:
-            new_chats.append(await ChatResult.gen(chat))
-
-        return self.get_template().render(
-            search_phrase=search_phrase,
-            chats=new_chats
+            chat.photo = photos.get(chat.photo, chat.photo)
+        new_chats = sorted(
+            results,
+            key=lambda result: result.last_message_date.timestamp() if result.last_message_date else 0,
+            reverse=True
         )
 
+        with stage('render'):
+            return self.get_template().render(
+                search_phrase=search_phrase,
+                chats=new_chats
+            )
+
 
 class TitleRenderer(BaseRenderer):
 
@@ -77,49 +107,78 @@ class TitleRenderer(BaseRenderer):
 class ReplyMessageRenderer(BaseRenderer):
     template = 'reply_message.html'
 
+    async def context(self, message: Message) -> typing.Optional[dict]:
+        # a prefetched empty relation is plain None, otherwise it is awaitable
+        reply = message.reply_message
+        if reply is not None:
+            reply = await reply
+        return await MessageRenderer(self.template).context(reply) if reply else None
+
+    def render_context(self, context: typing.Optional[dict]) -> typing.Optional[str]:
+        return MessageRenderer(self.template).render_context(context) if context else None
+
     async def render(self, message: Message) -> str:
-        reply = await message.reply_message
-        return await MessageRenderer(self.template).render(reply) if reply else None
+        return self.render_context(await self.context(message))
 
 
 class ForwardMessagesRenderer(BaseRenderer):
     template = 'fwd_messages.html'
 
-    async def render(self, fwd_messages: typing.List[dict]) -> typing.List[str]:
-        fwd_msgs = []
+    async def context(self, fwd_messages: typing.List[dict]) -> typing.List[dict]:
+        contexts = []
         for fwd_msg in fwd_messages:
             author = await tortoise_models.Author.get_or_create_from_vk(api, fwd_msg['from_id'])
-            fwd_msgs.append(
-                self.get_template().render(
-                    photo=author.photo,
-                    link=author.get_link(),
-                    name=author.title,
-                    date=datetime.datetime.fromtimestamp(fwd_msg['date']).strftime("%d.%m.%Y %H:%M"),
-                    text=prepare_text(fwd_msg['text']),
-                    fwd_messages=await ForwardMessagesRenderer().render(fwd_msg.get('fwd_messages'))
-                    if fwd_msg.get('fwd_messages')
-                    else None,
-                    attachments=await AttachmentsRenderer().render(fwd_msg.get('attachments', [])),
-                    **{
-                        k: v
-                        for k, v in fwd_msg.items()
-                        if k not in ('attachments', 'reply_message', 'fwd_messages', 'date', 'text',)
-                    }
-                )
-            )
-        return fwd_msgs
+            contexts.append(dict(
+                {
+                    k: v
+                    for k, v in fwd_msg.items()
+                    if k not in ('attachments', 'reply_message', 'fwd_messages', 'date', 'text',)
+                },
+                photo=author.photo,
+                link=author.get_link(),
+                name=author.title,
+                date=datetime.datetime.fromtimestamp(fwd_msg['date']).strftime("%d.%m.%Y %H:%M"),
+                text=fwd_msg['text'],
+                fwd_messages=await self.context(fwd_msg.get('fwd_messages') or []),
+                attachments=fwd_msg.get('attachments', [])
+            ))
+        return contexts
+
+    def render_context(self, contexts: typing.List[dict]) -> typing.List[str]:
+        template = self.get_template()
+        return [
+            template.render(**{
+                **context,
+                'text': prepare_text(context['text']),
+                'fwd_messages': self.render_context(context['fwd_messages']),
+                'attachments': attachments_renderer.render_context(context['attachments'])
+            })
+            for context in contexts
+        ]
+
+    async def render(self, fwd_messages: typing.List[dict]) -> typing.List[str]:
+        return self.render_context(await self.context(fwd_messages))
 
 
 class AttachmentsRenderer(BaseRenderer):
+    # attachment type -> template, None for types without a template
+    registry: typing.Dict[str, typing.Optional[Template]] = {}
 
-    @staticmethod
-    def get_template_by_attachment(type: str) -> typing.Optional[Template]:
-        try:
-            return jinja2_env.get_template(f'attachments/{type}.html')
-        except:
-            return None
+    @classmethod
+    def load_registry(cls):
+        for name in jinja2_env.list_templates(filter_func=lambda name: name.startswith('attachments/')):
+            cls.registry[name[len('attachments/'):-len('.html')]] = jinja2_env.get_template(name)
 
-    async def render(self, attachments: typing.List[dict]) -> typing.List[str]:
+    @classmethod
+    def get_template_by_attachment(cls, type: str) -> typing.Optional[Template]:
+        if type not in cls.registry:
+            try:
+                cls.registry[type] = jinja2_env.get_template(f'attachments/{type}.html')
+            except TemplateNotFound:
+                cls.registry[type] = None
+        return cls.registry[type]
+
+    def render_context(self, attachments: typing.List[dict]) -> typing.List[str]:
         atchs = []
         for attachment in attachments:
             template = self.get_template_by_attachment(attachment['type'])
@@ -127,37 +186,255 @@ class AttachmentsRenderer(BaseRenderer):
                 atchs.append(template.render(**attachment[attachment['type']]))
         return atchs
 
+    async def render(self, attachments: typing.List[dict]) -> typing.List[str]:
+        return self.render_context(attachments)
+
+
+AttachmentsRenderer.load_registry()
+attachments_renderer = AttachmentsRenderer()
+forward_messages_renderer = ForwardMessagesRenderer()
+
 
 class MessageRenderer(BaseRenderer):
     template = 'message.html'
 
-    async def render(self, message: Message) -> str:
+    # everything that needs the database is resolved here, the result is plain picklable data
+    async def context(self, message: Message) -> dict:
         author = await message.author
-        return self.get_template().render(
+        return dict(
             id=message.id,
             vk_link=message.vk_link,
             photo=author.photo,
             link=author.get_link(),
             name=author.title,
             date=message.date.strftime("%d.%m.%Y %H:%M"),
-            text=prepare_text(message.message_text),
-            reply_message=await ReplyMessageRenderer().render(message),
-            fwd_messages=await ForwardMessagesRenderer().render(message.fwd_messages),
-            attachments=await AttachmentsRenderer().render(message.attachments)
+            text=message.message_text,
+            edits=[
+                dict(date=change.date.strftime("%d.%m.%Y %H:%M"), text=change.message_text)
+                for change in message._changes
+                if change.type == Message.TypeEnum.EDIT_MESSAGE
+            ],
+            deleted=next((
+                change.date.strftime("%d.%m.%Y %H:%M")
+                for change in message._changes
+                if change.type == Message.TypeEnum.DELETE_MESSAGE
+            ), None),
+            reply_message=await ReplyMessageRenderer().context(message),
+            fwd_messages=await forward_messages_renderer.context(message.fwd_messages),
+            attachments=message.attachments
         )
 
+    def render_context(self, context: dict) -> str:
+        return self.get_template().render(**{
+            **context,
+            'text': prepare_text(context['text']),
+            'edits': [dict(edit, text=prepare_text(edit['text'])) for edit in context.get('edits', [])],
+            'reply_message': ReplyMessageRenderer().render_context(context['reply_message']),
+            'fwd_messages': forward_messages_renderer.render_context(context['fwd_messages']),
+            'attachments': attachments_renderer.render_context(context['attachments'])
+        })
+
+    async def render(self, message: Message) -> str:
+        return self.render_context(await self.context(message))
+
+
+def render_messages(contexts: typing.List[dict]) -> typing.List[str]:
+    renderer = MessageRenderer()
+    return [renderer.render_context(context) for context in contexts]
+
+
+def create_render_pool() -> typing.Optional[concurrent.futures.Executor]:
+    kind = os.environ.get("LOGGER_RENDER_POOL", "")
+    workers = int(os.environ.get("LOGGER_RENDER_WORKERS", "0")) or None
+    if kind == "thread":
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    if kind == "process":
+        return concurrent.futures.ProcessPoolExecutor(workers)
+    return None
+
+
+render_pool = create_render_pool()
+
+
+def templates_version() -> str:
+    digest = hashlib.sha1()
+    for name in sorted(jinja2_env.list_templates()):
+        digest.update(name.encode())
+        digest.update(jinja2_env.loader.get_source(jinja2_env, name)[0].encode())
+    return digest.hexdigest()
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+async def prepare_messages(messages: typing.List[Message]):
+    await Message.prefetch_replies(messages)
+    await Message.prefetch_changes(messages)
+    # warm the author cache for forwarded messages in one query, the replies show their forwards too
+    fwd_author_ids = set()
+    for message in messages:
+        while isinstance(message, Message):
+            for fwd_msg in message.fwd_messages:
+                fwd_author_ids |= Message.collect_author_ids(fwd_msg)
+            message = message.reply_message if message.reply_message_id else None
+    await tortoise_models.Author.get_or_create_many_from_vk(api, fwd_author_ids)
+
+
+async def render_fresh(messages: typing.List[Message]) -> typing.List[str]:
+    with stage('db'):
+        await prepare_messages(messages)
+        contexts = await tortoise_models.MediaFile.localize(
+            [await MessageRenderer().context(message) for message in messages]
+        )
+    with stage('render'):
+        if render_pool is None:
+            return render_messages(contexts)
+        return await asyncio.get_running_loop().run_in_executor(render_pool, render_messages, contexts)
+
+
+async def render_stored(messages: typing.List[Message]) -> typing.List[str]:
+    with stage('db'):
+        fragments = await tortoise_models.RenderedMessage.load(
+            (message.id for message in messages), TEMPLATES_VERSION
+        )
+    missing = [message for message in messages if message.id not in fragments]
+    if missing:
+        fragments.update(zip((message.id for message in missing), await render_fresh(missing)))
+    return [fragments[message.id] for message in messages]
+
+
+async def prerender(messages: typing.List[Message]) -> int:
+    fragments = await tortoise_models.RenderedMessage.load((message.id for message in messages), TEMPLATES_VERSION)
+    missing = [message for message in messages if message.id not in fragments]
+    if missing:
+        await Message.fetch_for_list(missing, 'author')
+        await tortoise_models.RenderedMessage.store(
+            dict(zip((message.id for message in missing), await render_fresh(missing))),
+            TEMPLATES_VERSION
+        )
+    return len(missing)
+
+
+async def prerender_all(chunk_size: int = 500):
+    last_id = None
+    rendered = 0
+    while True:
+        qs = Message.filter(type=Message.TypeEnum.NEW_MESSAGE).order_by('id').limit(chunk_size)
+        if last_id:
+            qs = qs.filter(id__gt=last_id)
+        messages = await qs
+        if not messages:
+            break
+        rendered += await prerender(messages)
+        last_id = messages[-1].id
+        logger.info(f"Rendered {rendered} messages")
+
+
+async def timeline(chat: tortoise_models.Chat) -> typing.List[dict]:
+    # a row of twelve months per year, bar heights relative to the busiest month
+    months = dict(await tortoise_models.ChatDayStat.months(chat.id))
+    peak = max(months.values(), default=0)
+    return [
+        dict(year=year, months=[
+            dict(
+                day=datetime.date(year, month, 1).isoformat(),
+                count=months.get(datetime.date(year, month, 1), 0),
+                share=round(months.get(datetime.date(year, month, 1), 0) * 100 / peak)
+            )
+            for month in range(1, 13)
+        ])
+        for year in sorted({month.year for month in months})
+    ]
+
 
 class LayoutRenderer(BaseRenderer):
     template = 'layout.html'
-
-    async def render(self, chat: tortoise_models.Chat, paginator: Paginator[Message], search_phrase: str) -> str:
-        _messages = []
-        for message in paginator.items:
-            _messages.append(await MessageRenderer().render(message))
-        return self.get_template().render(
-            messages=_messages,
+    # placeholders rendered in place of two messages to cut the layout into header, separator and footer
+    _MARKERS = ('<!--lrdl-message-0-->', '<!--lrdl-message-1-->')
+
+    async def layout_context(self, chat: tortoise_models.Chat, paginator: CursorPaginator[Message],
+                             search_phrase: str, messages: typing.List[str]) -> dict:
+        with stage('db'):
+            chat_timeline = await timeline(chat)
+        return dict(
+            messages=messages,
             title=await TitleRenderer().render(chat),
+            timeline=chat_timeline,
             chat_id=chat.id,
             paginator=paginator,
             search_phrase=search_phrase
         )
+
+    async def render(self, chat: tortoise_models.Chat, paginator: CursorPaginator[Message], search_phrase: str) -> str:
+        _messages = await render_stored(paginator.items)
+        context = await self.layout_context(chat, paginator, search_phrase, _messages)
+        with stage('render'):
+            return self.get_template().render(**context)
+
+    async def stream(self, chat: tortoise_models.Chat, paginator: CursorPaginator[Message], search_phrase: str,
+                     chunk_size: int = 50) -> typing.AsyncIterator[str]:
+        if not paginator.items:
+            yield await self.render(chat, paginator, search_phrase)
+            return
+
+        context = await self.layout_context(chat, paginator, search_phrase, list(self._MARKERS))
+        with stage('render'):
+            layout = "".join(self.get_template().generate(**context))
+        header, rest = layout.split(self._MARKERS[0], 1)
+        separator, footer = rest.split(self._MARKERS[1], 1)
+        yield header
+
+        for start in range(0, len(paginator.items), chunk_size):
+            rendered = await render_stored(paginator.items[start:start + chunk_size])
+            yield (separator if start else "") + separator.join(rendered)
+        yield footer
+
+
+@dataclasses.dataclass
+class SearchItem:
+    message: Message
+    snippet: str
+
+    @property
+    def chat_url(self) -> str:
+        return f"/{self.message.chat_id}?" + urllib.parse.urlencode({
+            'cursor': CursorPaginator.encode_cursor(self.message),
+            'direction': 'at'
+        })
+
+
+class SearchRenderer(BaseRenderer):
+    template = 'search.html'
+
+    async def render(
+            self,
+            search_phrase: str,
+            results: typing.List[tortoise_models.SearchResult],
+            chat: typing.Optional[tortoise_models.Chat],
+            page: int,
+            has_next: bool
+    ) -> str:
+        with stage('db'):
+            messages = {
+                str(message.id): message
+                for message in await Message.filter(
+                    id__in=[result.message_id for result in results]
+                ).prefetch_related('author', 'chat')
+            }
+            photos = await tortoise_models.MediaFile.local_urls(
+                {message.author.photo for message in messages.values()}
+            )
+        for message in messages.values():
+            message.author.photo = photos.get(message.author.photo, message.author.photo)
+        with stage('render'):
+            return self.get_template().render(
+                search_phrase=search_phrase,
+                chat=chat,
+                items=[
+                    SearchItem(messages[result.message_id], result.snippet)
+                    for result in results
+                    if result.message_id in messages
+                ],
+                page=page,
+                has_next=has_next
+            )
@@ -1,20 +1,22 @@
 import dataclasses
-import math
+import datetime
 import os.path
 import re
 import typing
+import urllib.parse
+import uuid
 
 import vkquick
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from tortoise import Model
 from tortoise.query_utils import Q
 
-from tortoise_models import Message
+from tortoise_models import ChatDayStat, Message
 
 api = vkquick.API(os.environ.get("USER_ACCESS_TOKEN"))
 
-user_regex = re.compile(r"\[id(\d+)\|([^]\n\f\t]+)\]")
-group_regex = re.compile(r"\[club(\d+)\|([^]\n\f\t]+)\]")
+# [id1|name] and [club1|name] mentions, line breaks are handled in the same pass
+mention_regex = re.compile(r"\[(id|club)(\d+)\|([^]\n\f\t]+)\]|\n")
 
 jinja2_env = Environment(
     loader=FileSystemLoader(
@@ -24,80 +26,120 @@ jinja2_env = Environment(
 )
 
 
-def prepare_text(text: str) -> str:
-    for user_id, user_name in re.findall(user_regex, text):
-        text = text.replace(
-            f"[id{user_id}|{user_name}]",
-            f'<a href="https://vk.com/id{user_id}" target="_blank">{user_name}</a>'
-        )
+def _replace_mention(match: re.Match) -> str:
+    kind, id_, name = match.groups()
+    if kind is None:
+        return "<br>"
+    return f'<a href="https://vk.com/{kind}{id_}" target="_blank">{name}</a>'
 
-    for group_id, group_name in re.findall(group_regex, text):
-        text = text.replace(
-            f"[club{group_id}|{group_name}]",
-            f'<a href="https://vk.com/club{group_id}" target="_blank">{group_name}</a>'
-        )
-    return "".join(f"{line}<br>" for line in text.split("\n")) if text else ""
+
+def prepare_text(text: str) -> str:
+    return f"{mention_regex.sub(_replace_mention, text)}<br>" if text else ""
 
 
 T = typing.TypeVar('T')
 
 
 @dataclasses.dataclass
-class Paginator(typing.Generic[T]):
+class CursorPaginator(typing.Generic[T]):
     items: typing.List[T]
     all_count: int
-    page: int
     has_next: bool
     has_prev: bool
-    all_page_count: int
+    base_url: str = ''
+    query: typing.Dict[str, str] = dataclasses.field(default_factory=dict)
+    # pages can be opened at a date with ?date=YYYY-MM-DD
+    date_jumps: typing.ClassVar[bool] = True
+
+    @staticmethod
+    def encode_cursor(item: Model) -> str:
+        return f"{item.date.isoformat()}_{item.id}"
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> typing.Tuple[datetime.datetime, uuid.UUID]:
+        date, id_ = cursor.rsplit('_', 1)
+        return datetime.datetime.fromisoformat(date), uuid.UUID(id_)
+
+    def url(self, **params: str) -> str:
+        params = {**self.query, **params}
+        return f"{self.base_url}?{urllib.parse.urlencode(params)}" if params else self.base_url
 
     @property
-    def next_page(self):
-        return self.page + 1
+    def first_url(self) -> str:
+        return self.url()
 
     @property
-    def prev_page(self):
-        return self.page - 1
+    def last_url(self) -> str:
+        return self.url(direction='last')
 
     @property
-    def xrange(self):
-        all_page_range = range(1, self.all_page_count + 1)
-        for i in range(self.page - 2, self.page + 3):
-            if i in all_page_range:
-                yield i
+    def next_url(self) -> str:
+        return self.url(cursor=self.encode_cursor(self.items[-1]), direction='next')
+
+    @property
+    def prev_url(self) -> str:
+        return self.url(cursor=self.encode_cursor(self.items[0]), direction='prev')
 
     @classmethod
     async def create(
-            cls: typing.Type["Paginator[T]"],
+            cls: typing.Type["CursorPaginator[T]"],
             model_cls: typing.Type[T],
             queryset: Q,
             count_per_page: int,
-            page: int = 1
-    ) -> "Paginator[T]":
-        count_all = await model_cls.filter(queryset).count()
-        current_position_min = (page - 1) * count_per_page
-        current_position_max = (page - 1) * count_per_page + count_per_page
-        qs = await model_cls.filter(queryset).offset((page - 1) * count_per_page).limit(count_per_page)
-
-        has_next: bool = False
-        has_prev: bool = False
-
-        if current_position_max < count_all:
-            has_next = True
-
-        if current_position_min > 0:
-            has_prev = True
-
-        all_page_count = math.floor(count_all / count_per_page)
+            cursor: typing.Optional[str] = None,
+            direction: str = 'next',
+            all_count: typing.Optional[int] = None,
+            prefetch: typing.Sequence[str] = (),
+            base_url: str = '',
+            query: typing.Dict[str, str] = None
+    ) -> "CursorPaginator[T]":
+        if all_count is None:
+            all_count = await model_cls.filter(queryset).count()
+
+        if direction == 'last':
+            cursor = None
+        elif not cursor:
+            direction = 'next'
+
+        if cursor:
+            date, id_ = cls.decode_cursor(cursor)
+            if direction == 'prev':
+                queryset &= Q(date__gt=date) | Q(date=date, id__gt=id_)
+            elif direction == 'at':
+                queryset &= Q(date__lt=date) | Q(date=date, id__lte=id_)
+            else:
+                queryset &= Q(date__lt=date) | Q(date=date, id__lt=id_)
+
+        ordering = ('date', 'id') if direction in ('prev', 'last') else ('-date', '-id')
+        items = list(
+            await model_cls.filter(queryset).order_by(*ordering).prefetch_related(*prefetch).limit(count_per_page + 1)
+        )
+        has_more = len(items) > count_per_page
+        items = items[:count_per_page]
 
-        if count_all % count_per_page != 0:
-            all_page_count += 1
+        if direction in ('prev', 'last'):
+            items.reverse()
+            has_next, has_prev = direction == 'prev', has_more
+        else:
+            has_next, has_prev = has_more, bool(cursor)
 
         return cls(
-            items=list(qs),
-            all_count=count_all,
-            page=page,
-            has_next=has_next,
-            has_prev=has_prev,
-            all_page_count=all_page_count
+            items=items,
+            all_count=all_count,
+            has_next=has_next and bool(items),
+            has_prev=has_prev and bool(items),
+            base_url=base_url,
+            query=query or {}
         )
+
+
+async def date_cursor(chat_id: int, queryset: Q, day: datetime.date) -> typing.Tuple[typing.Optional[str], str]:
+    # cursor and direction of the page ending with the first message sent on that day or later
+    if not await ChatDayStat.filter(chat_id=chat_id, day__gte=day).exists():
+        return None, 'next'
+    anchor = await Message.filter(
+        queryset, date__lt=datetime.datetime.combine(day, datetime.time())
+    ).order_by('-date', '-id').first()
+    if anchor is None:
+        return None, 'last'
+    return CursorPaginator.encode_cursor(anchor), 'prev'
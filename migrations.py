@@ -0,0 +1,80 @@
+import typing
+
+from loguru import logger
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from tortoise_models import SearchIndex, dialect, sql
+
+
+async def unique_message_id_type(conn: BaseDBAsyncClient):
+    # keep the first stored copy of every (message_id, type), point replies at it;
+    # postgres has no stable insertion order, there the smallest id wins
+    row = "rowid" if dialect(conn) == "sqlite" else "id::text"
+    await conn.execute_query(
+        f"CREATE TEMP TABLE message_keep AS "
+        f"SELECT message_id, type, MIN({row}) AS keep_row FROM message "
+        f"GROUP BY message_id, type HAVING COUNT(*) > 1"
+    )
+    await conn.execute_query(
+        f"CREATE TEMP TABLE message_duplicate AS "
+        f"SELECT m.id AS id, k.id AS keep_id FROM message m "
+        f"JOIN message_keep d ON d.message_id = m.message_id AND d.type = m.type "
+        f"JOIN message k ON k.{row} = d.keep_row "
+        f"WHERE m.{row} != d.keep_row"
+    )
+    duplicates = (await conn.execute_query_dict("SELECT COUNT(*) AS n FROM message_duplicate"))[0]['n']
+    if duplicates:
+        await conn.execute_query(
+            "UPDATE message SET reply_message_id = "
+            "(SELECT keep_id FROM message_duplicate WHERE id = message.reply_message_id) "
+            "WHERE reply_message_id IN (SELECT id FROM message_duplicate)"
+        )
+        await conn.execute_query(
+            f"DELETE FROM {SearchIndex.table} WHERE message_id IN (SELECT id FROM message_duplicate)"
+        )
+        await conn.execute_query("DELETE FROM renderedmessage WHERE message_id IN (SELECT id FROM message_duplicate)")
+        await conn.execute_query("DELETE FROM message WHERE id IN (SELECT id FROM message_duplicate)")
+        # counters included the duplicates, ChatStats.ensure rebuilds them from scratch
+        await conn.execute_query("DELETE FROM chatstats")
+        logger.warning(f"Removed {duplicates} duplicated messages")
+    await conn.execute_query("DROP TABLE message_duplicate")
+    await conn.execute_query("DROP TABLE message_keep")
+    await conn.execute_query(
+        "CREATE UNIQUE INDEX IF NOT EXISTS message_message_id_type_uniq ON message (message_id, type)"
+    )
+
+
+async def unique_message_versions(conn: BaseDBAsyncClient):
+    # a message may have any number of edits, one per edit time; originals and deletion markers stay unique
+    await conn.execute_query("DROP INDEX IF EXISTS message_message_id_type_uniq")
+    await conn.execute_query(
+        "CREATE UNIQUE INDEX IF NOT EXISTS message_message_id_type_uniq ON message (message_id, type) "
+        "WHERE type != 'e'"
+    )
+    await conn.execute_query(
+        "CREATE UNIQUE INDEX IF NOT EXISTS message_message_id_edit_date_uniq ON message (message_id, date) "
+        "WHERE type = 'e'"
+    )
+
+
+MIGRATIONS: typing.List[typing.Callable[[BaseDBAsyncClient], typing.Awaitable[None]]] = [
+    unique_message_id_type,
+    unique_message_versions,
+]
+
+
+async def migrate() -> int:
+    conn = Tortoise.get_connection("default")
+    await conn.execute_script("CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)")
+    rows = await conn.execute_query_dict("SELECT version FROM schema_version")
+    version = rows[0]['version'] if rows else 0
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info(f"Applying migration {number}: {migration.__name__}")
+        async with in_transaction() as transaction:
+            await migration(transaction)
+            await transaction.execute_query("DELETE FROM schema_version")
+            await transaction.execute_query(sql("INSERT INTO schema_version (version) VALUES (?)", conn), [number])
+        version = number
+    return version
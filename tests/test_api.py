@@ -0,0 +1,60 @@
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from benchmarks.fake_vk import FakeAPI
+from logger_server import api
+from logger_server.utils import CursorPaginator
+from tests.conftest import ingest
+from tortoise_models import Author, Message
+
+
+def test_api(run, corpus):
+    fake_api = FakeAPI(corpus)
+    peer_id = corpus.peer_ids[0]
+
+    async def test():
+        await ingest(fake_api)
+        app = web.Application()
+        api.setup(app)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(f'/api/chats/{peer_id}/messages', params={'count': '20'})
+            assert response.status == 200
+            page = await response.json()
+            assert len(page['items']) == 20
+            assert {str(item['author_id']) for item in page['items']} <= page['authors'].keys()
+
+            # a single message page, its reply's forwards are by authors it does not show otherwise
+            for message in await Message.filter(chat_id=peer_id, reply_message_id__not_isnull=True):
+                await Message.prefetch_replies([message], max_depth=1)
+                replied = message.reply_message
+                shown = {message.author_id, replied.author_id}
+                for fwd_msg in message.fwd_messages:
+                    shown |= Message.collect_author_ids(fwd_msg)
+                forward_authors = set()
+                for fwd_msg in replied.fwd_messages:
+                    forward_authors |= Message.collect_author_ids(fwd_msg)
+                if forward_authors - shown:
+                    break
+            else:
+                raise AssertionError("no reply with forwards in the corpus")
+            response = await client.get(f'/api/chats/{peer_id}/messages', params={
+                'count': '1', 'cursor': CursorPaginator.encode_cursor(message), 'direction': 'at'
+            })
+            page = await response.json()
+            assert [item['id'] for item in page['items']] == [str(message.id)]
+            assert {str(author_id) for author_id in forward_authors} <= page['authors'].keys()
+
+            for params in ({'count': 'abc'}, {'date': '2021-13-01'}, {'cursor': 'garbage'},
+                           {'cursor': 'garbage_ab'}):
+                response = await client.get(f'/api/chats/{peer_id}/messages', params=params)
+                assert response.status == 400
+
+            stored = await Author.all().count()
+            calls = sum(fake_api.calls.values())
+            response = await client.get('/api/authors', params={'ids': '1,2,987654321'})
+            assert set((await response.json())['authors']) == {'1', '2'}
+            # unknown ids are left out, nothing is fetched from VK or written
+            assert await Author.all().count() == stored
+            assert sum(fake_api.calls.values()) == calls
+
+    run(test)
@@ -0,0 +1,19 @@
+import datetime
+
+from logger_server import cache
+from logger_server.cache import PageCache
+
+
+def test_template_deploy_invalidates_pages(tmp_path, monkeypatch):
+    updated_at = datetime.datetime(2021, 5, 1, 12, 0)
+    page_cache = PageCache(directory=str(tmp_path))
+    version = page_cache.version(updated_at)
+    etag = page_cache.etag(1, version, ('chat', '', 'next', '100'))
+    page_cache.set(1, version, etag, b"<html>old</html>")
+
+    monkeypatch.setattr(cache, 'TEMPLATES_VERSION', "deployed")
+    new_version = page_cache.version(updated_at)
+    new_etag = page_cache.etag(1, new_version, ('chat', '', 'next', '100'))
+    assert new_etag != etag
+    # a restarted server must not find the old page on disk either
+    assert PageCache(directory=str(tmp_path)).get(1, new_version, etag) is None
@@ -0,0 +1,71 @@
+from benchmarks.fake_vk import FakeAPI
+from logger_client.live import MAX_ATTEMPTS, WriteBehindQueue
+from tortoise_models import Chat, Message
+
+
+def test_flush_retries_only_the_failed_chat(run, corpus, monkeypatch):
+    api = FakeAPI(corpus)
+    broken, working = corpus.peer_ids
+    bulk_parse = Message.bulk_parse
+    failures = []
+
+    async def flaky_bulk_parse(api, messages, type, chat, *args, **kwargs):
+        if chat.id == broken and len(failures) < MAX_ATTEMPTS - 1:
+            failures.append(chat.id)
+            raise RuntimeError("database is locked")
+        return await bulk_parse(api, messages, type, chat, *args, **kwargs)
+
+    monkeypatch.setattr(Message, 'bulk_parse', flaky_bulk_parse)
+
+    def stored(peer_id):
+        return Message.filter(
+            chat_id=peer_id,
+            message_id__in=[message['id'] for message in corpus.history[peer_id][:5]],
+            type=Message.TypeEnum.NEW_MESSAGE
+        ).count()
+
+    async def test():
+        await Chat.get_or_create_many_from_vk(api, corpus.peer_ids)
+        queue = WriteBehindQueue(flush_interval=60)
+        for peer_id in corpus.peer_ids:
+            for message in corpus.history[peer_id][:5][::-1]:
+                queue.put_message(api, message)
+        original = corpus.history[working][0]
+        queue.put_edit(api, dict(original, text="исправлено", update_time=original['date'] + 60))
+
+        await queue.flush()
+        assert await stored(working) == 5
+        assert await Message.filter(chat_id=broken).count() == 0
+        # the edit does not wait for the failed chat
+        assert await Message.filter(message_id=original['id'], type=Message.TypeEnum.EDIT_MESSAGE).count() == 1
+        assert len(queue) == 5
+
+        await queue.flush()
+        assert len(queue) == 5
+        queue.put_deletion(api, original['id'], working)
+        await queue.close()
+        assert len(queue) == 0
+        assert await stored(broken) == 5
+        assert await Message.filter(message_id=original['id'], type=Message.TypeEnum.DELETE_MESSAGE).count() == 1
+
+    run(test)
+
+
+def test_flush_drops_events_after_max_attempts(run, corpus, monkeypatch):
+    api = FakeAPI(corpus)
+
+    async def broken_bulk_parse(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(Message, 'bulk_parse', broken_bulk_parse)
+
+    async def test():
+        queue = WriteBehindQueue(flush_interval=60)
+        queue.put_message(api, corpus.history[corpus.peer_ids[0]][0])
+        for _ in range(MAX_ATTEMPTS - 1):
+            await queue.flush()
+            assert len(queue) == 1
+        await queue.flush()
+        assert len(queue) == 0
+
+    run(test)
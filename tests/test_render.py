@@ -0,0 +1,49 @@
+from tortoise.query_utils import Q
+
+import tortoise_models
+from benchmarks.fake_vk import FakeAPI
+from instrumentation import RequestStats, count_queries, current_request
+from logger_server import renderer
+from logger_server.utils import CursorPaginator
+from tests.conftest import ingest
+from tortoise_models import Message
+
+# a handful of batched lookups per page, however many messages, replies and forwards it has
+PAGE_QUERIES = 10
+
+
+def test_page_queries_do_not_grow_with_messages(run, corpus, monkeypatch):
+    api = FakeAPI(corpus)
+    # forwarded authors missing from the database are fetched through the renderer's api
+    monkeypatch.setattr(renderer, 'api', api)
+    count_queries()
+
+    async def render(chat, qs, count, cursor=None) -> int:
+        # the page query itself, with the authors prefetched, is made the way show_chat does
+        paginator = await CursorPaginator.create(Message, qs, count, cursor=cursor, prefetch=('author',))
+        tortoise_models.GetMixin._cache.clear()
+        stats = RequestStats()
+        token = current_request.set(stats)
+        try:
+            html = await renderer.LayoutRenderer().render(chat, paginator, '')
+        finally:
+            current_request.reset(token)
+        assert len(paginator.items) == count
+        assert html.count('<div class="card">') >= count
+        return stats.queries
+
+    async def test():
+        chats = await ingest(api)
+        peer_id = corpus.peer_ids[0]
+        qs = Q(chat_id=peer_id, type=Message.TypeEnum.NEW_MESSAGE)
+        messages = await Message.filter(qs).order_by('-date', '-id')
+        assert sum(bool(message.fwd_messages) for message in messages[:200]) > 20
+        assert sum(bool(message.reply_message_id) for message in messages[:200]) > 20
+
+        # the forwarded authors are stored by the first render of each page, count the second one
+        for count, start in ((200, 0), (200, 50), (200, 99), (50, 0), (50, 120), (10, 250)):
+            cursor = CursorPaginator.encode_cursor(messages[start])
+            await render(chats[peer_id], qs, count, cursor)
+            assert await render(chats[peer_id], qs, count, cursor) <= PAGE_QUERIES
+
+    run(test)
@@ -0,0 +1,34 @@
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from benchmarks.fake_vk import FakeAPI
+from logger_server import __main__ as server
+from tests.conftest import ingest
+
+
+def test_bad_parameters(run, corpus):
+    api = FakeAPI(corpus)
+    peer_id = corpus.peer_ids[0]
+
+    async def test():
+        await ingest(api)
+        # the server's handlers without its startup hooks, the database is already open
+        app = web.Application()
+        app.router.add_get('/search', server.search)
+        app.router.add_get(r'/{peer_id}', server.show_chat)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(f'/{peer_id}', params={'count': '20'})
+            assert response.status == 200
+            for params in ({'count': 'abc'}, {'date': '2021-13-01'}, {'cursor': 'garbage'},
+                           {'cursor': 'garbage_ab'}):
+                response = await client.get(f'/{peer_id}', params=params)
+                assert response.status == 400, params
+
+            for params in ({'q': 'a', 'page': '0'}, {'q': 'a', 'page': '-3', 'peer_id': str(peer_id)}):
+                response = await client.get('/search', params=params)
+                assert response.status == 200, params
+            for params in ({'q': 'a', 'page': 'x'}, {'q': 'a', 'peer_id': 'x'}):
+                response = await client.get('/search', params=params)
+                assert response.status == 400, params
+
+    run(test)
@@ -0,0 +1,149 @@
+import datetime
+
+from tortoise.query_utils import Q
+from tortoise.transactions import in_transaction
+
+from benchmarks.fake_vk import FakeAPI
+from logger_server.utils import CursorPaginator
+from tests.conftest import ingest
+from tortoise_models import ChatDayStat, ChatStats, Message, SearchIndex
+
+
+def test_bulk_parse_skips_stored_messages(run, corpus):
+    api = FakeAPI(corpus)
+    peer_id = corpus.peer_ids[0]
+    history = corpus.history[peer_id]
+
+    async def test():
+        chats = await ingest(api)
+        count = await Message.all().count()
+        assert await Message.filter(chat_id=peer_id, type=Message.TypeEnum.NEW_MESSAGE).count() == len(history)
+
+        # the same page again and a page overlapping it store nothing new
+        assert await Message.bulk_parse(api, history[:200], Message.TypeEnum.NEW_MESSAGE, chats[peer_id]) == 0
+        assert await Message.bulk_parse(api, history[100:300], Message.TypeEnum.NEW_MESSAGE, chats[peer_id]) == 0
+        # rows with an unseen message_id slip past the lookup and are dropped by ON CONFLICT DO NOTHING
+        rows = [
+            Message(message_id=msg['id'], chat_id=peer_id, author_id=msg['from_id'], message_text=msg['text'],
+                    date=datetime.datetime.fromtimestamp(msg['date']))
+            for msg in history[:10]
+        ]
+        async with in_transaction() as conn:
+            assert await Message.insert_new(rows, conn) == []
+        assert await Message.all().count() == count
+
+        replied = [msg for msg in history if msg.get('reply_message')]
+        assert replied
+        for msg in replied:
+            assert await Message.filter(message_id=msg['reply_message']['id'], type='n').count() == 1
+        # a message first stored as the copy inside another reply has no reply of its own
+        reply_targets = {msg['reply_message']['id'] for msg in replied}
+        for msg in replied:
+            if msg['id'] in reply_targets:
+                continue
+            stored = await Message.get(message_id=msg['id'], type='n').prefetch_related('reply_message')
+            assert stored.reply_message.message_id == msg['reply_message']['id']
+
+    run(test)
+
+
+def test_search(run, corpus):
+    api = FakeAPI(corpus)
+    peer_id = corpus.peer_ids[0]
+    target = corpus.history[peer_id][10]
+    target['text'] = "заметка про кракозябру"
+
+    async def test():
+        await ingest(api)
+        stored = await Message.get(message_id=target['id'], type='n')
+
+        results = await SearchIndex.search("кракозяб")
+        assert [result.message_id for result in results] == [str(stored.id)]
+        assert "<mark>" in results[0].snippet
+        assert await SearchIndex.search("кракозяб", chat_id=corpus.peer_ids[1]) == []
+
+        for result in await SearchIndex.search("привет", chat_id=peer_id, limit=500):
+            message = await Message.get(id=result.message_id)
+            assert message.chat_id == peer_id
+            assert "привет" in message.message_text + SearchIndex.fwd_text(message.fwd_messages)
+
+        # an edit is stored as a version of the message and stays out of the index, also after a rebuild
+        await Message.record_changes(
+            api, [dict(target, text="заметка про абракадабру", update_time=target['date'] + 60)], []
+        )
+        await SearchIndex.rebuild()
+        assert await SearchIndex.search("абракадабр") == []
+        assert [result.message_id for result in await SearchIndex.search("кракозяб")] == [str(stored.id)]
+
+    run(test)
+
+
+def test_cursor_pagination(run, corpus):
+    api = FakeAPI(corpus)
+    peer_id = corpus.peer_ids[0]
+
+    async def test():
+        await ingest(api)
+        qs = Q(chat_id=peer_id, type=Message.TypeEnum.NEW_MESSAGE)
+        expected = [message.id for message in await Message.filter(qs).order_by('-date', '-id')]
+
+        seen, cursor = [], None
+        while True:
+            paginator = await CursorPaginator.create(Message, qs, 70, cursor=cursor)
+            seen += [message.id for message in paginator.items]
+            if not paginator.has_next:
+                break
+            cursor = CursorPaginator.encode_cursor(paginator.items[-1])
+        assert seen == expected
+
+        # and back from the oldest page
+        seen = []
+        paginator = await CursorPaginator.create(Message, qs, 70, direction='last')
+        while True:
+            seen = [message.id for message in paginator.items] + seen
+            if not paginator.has_prev:
+                break
+            paginator = await CursorPaginator.create(
+                Message, qs, 70, cursor=CursorPaginator.encode_cursor(paginator.items[0]), direction='prev'
+            )
+        assert seen == expected
+
+        at = await CursorPaginator.create(Message, qs, 5, cursor=CursorPaginator.encode_cursor(
+            await Message.get(id=expected[100])
+        ), direction='at')
+        assert [message.id for message in at.items] == expected[100:105]
+
+    run(test)
+
+
+def test_counters(run, corpus):
+    api = FakeAPI(corpus)
+
+    async def test():
+        await ingest(api)
+        live_days = sorted(await ChatDayStat.all().values_list('chat_id', 'day', 'message_count'))
+        live_stats = sorted(await ChatStats.all().values_list('chat_id', 'message_count'))
+
+        for peer_id in corpus.peer_ids:
+            stored = await Message.filter(chat_id=peer_id, type=Message.TypeEnum.NEW_MESSAGE)
+            assert dict(live_stats)[peer_id] == len(stored)
+            days = {}
+            for message in stored:
+                days[message.date.date()] = days.get(message.date.date(), 0) + 1
+            assert {day: count for chat_id, day, count in live_days if chat_id == peer_id} == days
+            assert sum(count for _, count in await ChatDayStat.months(peer_id)) == len(stored)
+
+        # edits and deletions are not messages of their own
+        message = corpus.history[corpus.peer_ids[0]][0]
+        await Message.record_changes(
+            api,
+            [dict(message, text="исправлено", update_time=message['date'] + 60)],
+            [(message['id'], message['peer_id'], datetime.datetime.now())]
+        )
+        assert sorted(await ChatStats.all().values_list('chat_id', 'message_count')) == live_stats
+
+        await ChatStats.rebuild()
+        assert sorted(await ChatDayStat.all().values_list('chat_id', 'day', 'message_count')) == live_days
+        assert sorted(await ChatStats.all().values_list('chat_id', 'message_count')) == live_stats
+
+    run(test)